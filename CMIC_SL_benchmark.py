@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic CMIC/SL job files and a throughput benchmark for
+CMIC_SL_comparison.py
+"""
+
+import pandas as pd
+import numpy as np
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import CMIC_SL_comparison as comparison
+
+
+###############################################################################
+#.........................Synthetic jobs......................................#
+###############################################################################
+
+# Each generated line exists once in CMIC and once in SL with matching keys,
+# apart from a share of lines missing on one side or carrying a changed
+# amount, so the comparison has realistic matches and mismatches
+JOB_NAMES = ['BRIDGE REHAB', 'SEAWALL REPLACEMENT', 'PUMP STATION UPGRADE']
+VENDOR_NAMES = ['ACME CONCRETE INCORPORATED', 'Bay Steel', 'PACIFIC REBAR CO',
+                'DELTA EXCAVATION', 'X']
+ITEM_NAMES = ['CONCRETE FORMS FOR THE NORTH ABUTMENT WALL', 'Rebar',
+              'Excavation', 'TRAFFIC CONTROL', 'Dewatering and shoring']
+PHASES = [101000, 2020000, 303000, 4040000]
+QTY_TYPES = ['LS', 'CY', 'EA', 'SF']
+DATES = pd.date_range('2019-01-01', periods=365).strftime('%Y-%m-%d').to_numpy()
+N_EXTRA_CMIC = 20
+N_SL_COLS = 130
+BLOCK = 100000
+
+def make_lines(job_no, start, n, rng):
+    # One block of contract/CO lines. Item numbers are unique within a job
+    co = rng.random(n) < 0.3
+    lines = pd.DataFrame({
+        'job_no': job_no,
+        'job_name': JOB_NAMES[job_no % len(JOB_NAMES)],
+        'subcontract_no': rng.integers(1, 40, n),
+        'vendor': rng.integers(0, len(VENDOR_NAMES), n),
+        'item_no': np.arange(start+1, start+n+1),
+        'item_name': rng.choice(ITEM_NAMES, n),
+        'category': rng.integers(1, 6, n),
+        'phase_no': rng.choice(PHASES, n),
+        'job_cost_no': rng.integers(1, 999, n),
+        'co': co,
+        'co_date': rng.choice(DATES, n),
+        'qty': np.round(rng.random(n)*5000, 2),
+        'qty_type': rng.choice(QTY_TYPES, n),
+        'dollar_amount': np.round(rng.random(n)*1e6, 2),
+        'cont_total': np.round(rng.random(n)*1e8, 2),
+        'vendor_total': np.round(rng.random(n)*1e7, 2),
+        })
+    lines['vendor_no'] = 1000 + lines['vendor']
+    lines['vendor_name'] = np.array(VENDOR_NAMES)[lines['vendor']]
+    return lines
+
+def cmic_block(lines, rng):
+    n = len(lines)
+    job_no = lines['job_no'].astype(float)
+    # Blank trailing lines in the vendor dump come through without a job
+    job_no[rng.random(n) < 0.005] = np.nan
+    df = pd.DataFrame({
+        'VLS_JOBVEN1_CODE': job_no,
+        'VLS_JOBVEN1_NAME': lines['job_name'],
+        'VLS_CONT_CODE': [str(j)+'-'+str(s) for j, s in
+                          zip(lines['job_no'], lines['subcontract_no'])],
+        'VLS_JOBVEN2_CODE': lines['vendor_no'].astype(float),
+        'VLS_JOBVEN2_NAME': lines['vendor_name'],
+        'VLS_SCH_TASK_CODE': lines['item_no'].astype(float),
+        'VLS_SCH_TASK_NAME': lines['item_name'],
+        'VLS_SCH_CAT_CODE': lines['category']*100.0,
+        'VLS_SCH_PHS_CODE': lines['phase_no'],
+        'VLS_SCH_JOB_CODE': lines['job_cost_no'].astype(float),
+        'VLS_CHG_CODE': np.where(lines['co'], rng.integers(1, 30, n), 0),
+        'VLS_MST_DATE': lines['co_date'],
+        'VLS_SCH_UNIT': lines['qty'],
+        'VLS_SCH_WM_CODE': lines['qty_type'],
+        'VLS_SCH_AMT': lines['dollar_amount'],
+        'VLS_CONT_AMT': lines['cont_total'],
+        'CS_JV2_CONT_AMT': lines['vendor_total'],
+        })
+    for i in range(N_EXTRA_CMIC):
+        df['VLS_EXTRA_'+str(i)] = rng.random(n)
+    return df
+
+def amounts(values):
+    return ['{:,.2f}'.format(value) for value in values]
+
+def sl_block(lines):
+    # Positional SL report rows with the text layouts that clean_sl parses
+    n = len(lines)
+    df = pd.DataFrame(index=range(n), columns=range(N_SL_COLS), dtype=object)
+    df[20] = ['Subcontract No : {0}-{1} Vendor : Vendor No {2}  {3}'.format(j, s, v, name)
+              for j, s, v, name in zip(lines['job_no'], lines['subcontract_no'],
+                                       lines['vendor_no'], lines['vendor_name'])]
+    df[26] = ['Job : Job # {0}-00 - {1}'.format(j, name)
+              for j, name in zip(lines['job_no'], lines['job_name'])]
+    df[41] = ['Item : Code: {}'.format(item) for item in lines['item_no']]
+    df[42] = ['{0}  Phase: {1}.  JC {2}- Cat: {3}'.format(name,
+              str(phase)+'0' if len(str(phase)) == 6 else phase, jc, cat)
+              for name, phase, jc, cat in zip(lines['item_name'], lines['phase_no'],
+                                              lines['job_cost_no'], lines['category'])]
+
+    # Contract lines repeat the contract amount in 48, change orders do not
+    co = lines['co'].to_numpy()
+    dollars = lines['dollar_amount'].to_numpy()
+    df[47] = amounts(np.where(co, dollars + 1000, dollars))
+    df[48] = amounts(np.where(co, dollars + 2000, dollars))
+    df[56] = np.where(co, None, lines['qty_type'])
+    df[57] = amounts(lines['qty'])
+    df[102] = np.where(co, lines['co_date'], None)
+    df[105] = np.where(co, lines['qty_type'], None)
+    df[106] = amounts(lines['qty'])
+    df[108] = amounts(dollars)
+    df[128] = amounts(lines['cont_total'])
+    df[129] = amounts(lines['vendor_total'])
+    return df
+
+def write_job(loc, job_no, rows, mismatch=0.05, seed=0):
+    # Writes 'cmic <job_no>.txt' and 'sl <job_no>.csv' of about rows lines
+    # each, block by block so 10M-row jobs fit in memory
+    rng = np.random.default_rng(seed)
+    cmic_file = os.path.join(loc, 'cmic {}.txt'.format(job_no))
+    sl_file = os.path.join(loc, 'sl {}.csv'.format(job_no))
+    for start in range(0, rows, BLOCK):
+        lines = make_lines(job_no, start, min(BLOCK, rows-start), rng)
+
+        # Half the mismatches are lines missing from one side, the rest are
+        # changed amounts
+        n = len(lines)
+        missing = rng.random(n) < mismatch/2
+        in_cmic = ~missing | (rng.random(n) < 0.5)
+        in_sl = ~missing | ~in_cmic
+        sl_lines = lines.copy()
+        changed = rng.random(n) < mismatch/2
+        sl_lines.loc[changed, 'dollar_amount'] += 100
+
+        cmic_block(lines[in_cmic], rng).to_csv(
+            cmic_file, sep='\t', index=False, header=(start == 0),
+            mode='w' if start == 0 else 'a')
+        sl_block(sl_lines[in_sl].reset_index(drop=True)).to_csv(
+            sl_file, index=False, header=False, mode='w' if start == 0 else 'a')
+    return cmic_file, sl_file
+
+
+###############################################################################
+#.........................Benchmark...........................................#
+###############################################################################
+
+def run_stage(func, repeat=3):
+    # Best of repeat for time, then one more run under tracemalloc for the
+    # peak Python/NumPy allocation of the stage
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+        del result
+
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(seconds), peak, result
+
+def benchmark_job(loc, job_no, cmic_file, sl_file, engine='c', repeat=3):
+    results = []
+    def stage(name, func, n=None):
+        seconds, peak, result = run_stage(func, repeat)
+        n = len(result) if n is None else n
+        results.append({'stage': name, 'rows': n, 'seconds': seconds,
+                        'rows_per_sec': n/seconds if seconds else np.nan,
+                        'peak_mb': peak/2**20})
+        print("  {0:<12}{1:>10,} rows {2:>9.3f} s {3:>12,.0f} rows/s {4:>9.1f} MB"
+              .format(name, n, seconds, results[-1]['rows_per_sec'], peak/2**20))
+        return result
+
+    # Throughput of every stage is counted in input lines
+    cmic_raw = stage('read_cmic', lambda: comparison.read_cmic(cmic_file, engine))
+    sl_raw = stage('read_sl', lambda: comparison.read_sl(sl_file, engine))
+    rows = len(cmic_raw) + len(sl_raw)
+    cmic = stage('clean_cmic', lambda: comparison.clean_cmic(cmic_raw.copy()),
+                 len(cmic_raw))
+    sl = stage('clean_sl', lambda: comparison.clean_sl(sl_raw.copy()), len(sl_raw))
+    del cmic_raw, sl_raw
+    stage('compare_dfs', lambda: comparison.compare_dfs(cmic, sl), rows)
+    del cmic, sl
+
+    # End to end, as run from the command line but without the cache
+    with tempfile.TemporaryDirectory(dir=loc) as out:
+        out += os.sep
+        os.link(cmic_file, out+os.path.basename(cmic_file))
+        os.link(sl_file, out+os.path.basename(sl_file))
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                return comparison.file_loader(out, engine=engine)
+        stage('file_loader', run, rows)
+
+    for result in results:
+        result['job_no'] = job_no
+    return results
+
+def check_baseline(results, baseline_file, threshold):
+    # A stage is a regression when its throughput drops by more than
+    # threshold against the baseline run at the same size
+    baseline = pd.read_csv(baseline_file)
+    merged = results.merge(baseline, on=['stage', 'rows'], suffixes=('', '_base'))
+    merged['change'] = merged['rows_per_sec']/merged['rows_per_sec_base'] - 1
+    slower = merged[merged['change'] < -threshold]
+    for _, row in slower.iterrows():
+        print("REGRESSION {0} at {1:,} rows: {2:,.0f} rows/s vs {3:,.0f} ({4:+.0%})"
+              .format(row['stage'], row['rows'], row['rows_per_sec'],
+                      row['rows_per_sec_base'], row['change']))
+    return slower.empty
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='generate synthetic CMIC/SL jobs and time each stage of '
+        'the comparison on them')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help='job sizes in lines, e.g. 10000 1000000 10000000')
+    parser.add_argument('--mismatch', type=float, default=0.05,
+                        help='share of lines that differ between CMIC and SL')
+    parser.add_argument('--engine', choices=['c', 'pyarrow'], default='c',
+                        help='CSV parser used to read CMIC and SL files')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs per stage, the best one is reported')
+    parser.add_argument('--data-dir', default=None,
+                        help='keep the generated files here instead of a '
+                        'temporary directory')
+    parser.add_argument('--output', default=None,
+                        help='save the results to this CSV file')
+    parser.add_argument('--baseline', default=None,
+                        help='results CSV of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='throughput drop against the baseline that counts '
+                        'as a regression')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        loc = args.data_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(loc, exist_ok=True)
+
+        results = []
+        for i, rows in enumerate(args.rows):
+            job_no = 900000 + i
+            start = time.perf_counter()
+            cmic_file, sl_file = write_job(loc, job_no, rows, args.mismatch, seed=i)
+            print("Job {0}: {1:,} lines generated in {2:.1f} s".format(
+                job_no, rows, time.perf_counter() - start))
+            results += benchmark_job(loc, str(job_no), cmic_file, sl_file,
+                                     args.engine, args.repeat)
+
+    results = pd.DataFrame(results)
+    if args.output:
+        results.to_csv(args.output, index=False)
+        print("Results saved to '{}'".format(args.output))
+    if args.baseline and not check_baseline(results, args.baseline, args.threshold):
+        sys.exit(1)
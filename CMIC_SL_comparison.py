@@ -6,9 +6,26 @@ Created on Wed Oct  9 19:39:18 2019
 """
 
 import pandas as pd
+import numpy as np
 import argparse
+import cProfile
 import glob
-# import os
+import hashlib
+import json
+import os
+import pstats
+import re
+import shutil
+import sys
+import tempfile
+import time
+import bz2
+import gzip
+import lzma
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 #os.chdir('/Users/aksin/Projects/ShimmickDataVal/data')
 
@@ -22,6 +39,149 @@ def combine_cols(df, cols):
     else:
         return df[cols[0]] + '_' + combine_cols(df, cols[1:])
 
+def build_id(df, cols):
+    # Single pass over all key columns instead of one intermediate Series per
+    # concatenation level. Rows missing any key get NaN, as with combine_cols
+    keys = [df[col].to_numpy() for col in cols]
+    missing = np.logical_or.reduce([pd.isnull(key) for key in keys])
+    ids = np.full(len(df), np.nan, dtype=object)
+    ids[~missing] = ['_'.join(vals) for vals in zip(*[key[~missing] for key in keys])]
+    return pd.Series(ids, index=df.index)
+
+def map_unique(col, func):
+    # Source columns repeat the same job, vendor and item values on every
+    # line, so func runs once per distinct value and the result is broadcast
+    # back by code. NaN is kept as its own value so func still sees it
+    codes, uniques = pd.factorize(col)
+    if (codes == -1).any():
+        uniques = np.append(uniques, np.nan)
+        codes[codes == -1] = len(uniques) - 1
+    result = func(pd.Series(uniques)).take(codes)
+    result.index = col.index
+    return result
+
+def short_name(col, n):
+    return col.astype(str).str.slice(0, n).str.strip().str.lower()
+
+def pad_phase(phase_no):
+    phase_no = phase_no.astype(str)
+    return phase_no.mask(phase_no.str.len() == 6, phase_no + '0')
+
+def to_numeric(col):
+    return pd.to_numeric(col, errors="coerce")
+
+ID_COLS = ['job_no', 'subcontract_no', 'item_no', 'phase_no', 'category', 
+           'cont_or_co']
+
+
+###############################################################################
+#.........................Instrumentation.....................................#
+###############################################################################
+
+# Open collect_stages blocks, innermost last. Stages timed outside of one, 
+# e.g. when compare_dfs is called directly, are not recorded
+STAGE_COLLECTORS = []
+
+def peak_rss_mb():
+    # On Linux the high-water mark is reset at the start of every stage, so 
+    # this is the peak of the stage. Elsewhere it is the peak of the process
+    # so far, and it is not available on Windows
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 1024
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+@contextmanager
+def timed(stage, rows_in=None):
+    # Records wall time and peak memory of a stage in the innermost 
+    # collect_stages block. The caller can set 'rows_out' on the yielded 
+    # record. Stages that fail are not recorded
+    record = {'stage': stage, 'rows_in': rows_in, 'rows_out': None}
+    reset_peak_rss()
+    start = time.perf_counter()
+    yield record
+    record['seconds'] = time.perf_counter() - start
+    record['peak_rss_mb'] = peak_rss_mb()
+    if STAGE_COLLECTORS:
+        STAGE_COLLECTORS[-1].append(record)
+
+@contextmanager
+def collect_stages(job_no):
+    # Yields the list that the stages timed inside the block are added to, 
+    # tagged with job_no once the block ends
+    stages = []
+    STAGE_COLLECTORS.append(stages)
+    try:
+        yield stages
+    finally:
+        STAGE_COLLECTORS.pop()
+        for record in stages:
+            record['job_no'] = job_no
+
+def stage_times(stages):
+    # Seconds per stage in the order the stages first ran. Streamed jobs run
+    # merge, compare_cols and write once per bucket
+    times = {}
+    for record in stages:
+        times[record['stage']] = times.get(record['stage'], 0) + record['seconds']
+    return times.items()
+
+RUN_LOG_FILE = 'comparison_run_log.csv'
+
+def write_run_log(loc, run_log):
+    # One row per job and stage, appended so that runs can be compared
+    log = pd.DataFrame(run_log, columns=['job_no', 'stage', 'rows_in', 'rows_out', 
+                                         'seconds', 'peak_rss_mb'])
+    total = lambda col: col.sum(min_count=1)
+    log = log.groupby(['job_no', 'stage'], sort=False).agg(
+        calls=('seconds', 'size'), rows_in=('rows_in', total), 
+        rows_out=('rows_out', total), seconds=('seconds', 'sum'), 
+        peak_rss_mb=('peak_rss_mb', 'max')).reset_index()
+    log[['rows_in', 'rows_out']] = log[['rows_in', 'rows_out']].astype('Int64')
+    log.insert(0, 'run', pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'))
+    
+    new = not os.path.exists(loc+RUN_LOG_FILE)
+    log.to_csv(loc+RUN_LOG_FILE, mode='a', header=new, index=False, 
+               float_format='%.3f')
+    print("Stage timings saved to '{}'".format(loc+RUN_LOG_FILE))
+
+def profile_file(loc, job_no):
+    return loc+'comparison_'+job_no+'.prof'
+
+def keep_slowest_profile(loc, run_log):
+    # Every job was profiled; only the slowest one's stats are kept
+    totals = {record['job_no']: record['seconds'] for record in run_log 
+              if record['stage'] == 'total'}
+    profiled = [job_no for job_no in totals 
+                if os.path.exists(profile_file(loc, job_no))]
+    if not profiled:
+        return
+    slowest = max(profiled, key=totals.get)
+    for job_no in profiled:
+        if job_no != slowest:
+            os.remove(profile_file(loc, job_no))
+    
+    print("===================================================\n",
+          "Profile of the slowest job, {0}, saved to '{1}'".format(
+              slowest, profile_file(loc, slowest)))
+    pstats.Stats(profile_file(loc, slowest)).sort_stats('cumulative').print_stats(20)
+
 
 ###############################################################################
 #.........................Clean up CMIC.......................................#
@@ -32,19 +192,68 @@ def cmic_cont_or_co(val):
     else:
         return 'CO'
 
-def clean_cmic(df):
-    df.rename(columns={'VLS_JOBVEN1_CODE': 'job_no', 'VLS_JOBVEN1_NAME': 
-        'job_name', 'VLS_CONT_CODE': 'subcontract_no',
-        'VLS_JOBVEN2_CODE': 'vendor_no', 'VLS_JOBVEN2_NAME': 'vendor_name', 
-        'VLS_SCH_TASK_CODE': 'item_no', 'VLS_SCH_TASK_NAME': 'item_name',
-        'VLS_SCH_CAT_CODE': 'category', 
-        'VLS_SCH_PHS_CODE': 'phase_no', 'VLS_SCH_JOB_CODE': 'job_cost_no', 
-        'VLS_CHG_CODE': 'co_code', 'VLS_MST_DATE': 'co_date', 
-        'VLS_SCH_UNIT': 'qty', 'VLS_SCH_WM_CODE': 'qty_type', 
-        'VLS_SCH_AMT': 'dollar_amount',
-        'VLS_CONT_AMT': 'cont_total', 'CS_JV2_CONT_AMT': 'vendor_total'
-        },
-    inplace=True)
+CMIC_COLUMNS = {
+    'VLS_JOBVEN1_CODE': 'job_no', 'VLS_JOBVEN1_NAME': 'job_name', 
+    'VLS_CONT_CODE': 'subcontract_no',
+    'VLS_JOBVEN2_CODE': 'vendor_no', 'VLS_JOBVEN2_NAME': 'vendor_name', 
+    'VLS_SCH_TASK_CODE': 'item_no', 'VLS_SCH_TASK_NAME': 'item_name',
+    'VLS_SCH_CAT_CODE': 'category', 
+    'VLS_SCH_PHS_CODE': 'phase_no', 'VLS_SCH_JOB_CODE': 'job_cost_no', 
+    'VLS_CHG_CODE': 'co_code', 'VLS_MST_DATE': 'co_date', 
+    'VLS_SCH_UNIT': 'qty', 'VLS_SCH_WM_CODE': 'qty_type', 
+    'VLS_SCH_AMT': 'dollar_amount',
+    'VLS_CONT_AMT': 'cont_total', 'CS_JV2_CONT_AMT': 'vendor_total'
+    }
+
+# Dtype each CMIC_COLUMNS column is read as. Codes are read as floats, as 
+# they come out of a plain read_table when blank lines leave gaps, and are 
+# turned into text once per distinct value by convert_to_str. Phase numbers 
+# are read as text, since pad_phase works on their printed form and a float 
+# column would print '303000.0' wherever a chunk has blank lines
+CMIC_SCHEMA = {
+    'VLS_JOBVEN1_CODE': float, 'VLS_JOBVEN1_NAME': str, 
+    'VLS_CONT_CODE': str,
+    'VLS_JOBVEN2_CODE': float, 'VLS_JOBVEN2_NAME': str, 
+    'VLS_SCH_TASK_CODE': float, 'VLS_SCH_TASK_NAME': str,
+    'VLS_SCH_CAT_CODE': float, 
+    'VLS_SCH_PHS_CODE': str, 'VLS_SCH_JOB_CODE': float, 
+    'VLS_CHG_CODE': str, 'VLS_MST_DATE': str, 
+    'VLS_SCH_UNIT': float, 'VLS_SCH_WM_CODE': str, 
+    'VLS_SCH_AMT': float,
+    'VLS_CONT_AMT': float, 'CS_JV2_CONT_AMT': float
+    }
+
+def read_cmic(cmic_file, engine='c', chunksize=None):
+    # Only the CMIC_COLUMNS are parsed out of the vendor dump
+    if engine == 'pyarrow':
+        if chunksize:
+            raise ValueError("The pyarrow CMIC reader does not read in chunks")
+        return read_cmic_pyarrow(cmic_file)
+    return pd.read_table(cmic_file, encoding="ISO-8859-1", 
+                         usecols=list(CMIC_COLUMNS), dtype=CMIC_SCHEMA, 
+                         engine=engine, chunksize=chunksize)
+
+def read_cmic_pyarrow(cmic_file):
+    import pyarrow
+    from pyarrow import csv
+    
+    types = {str: pyarrow.string(), float: pyarrow.float64()}
+    table = csv.read_csv(
+        cmic_file,
+        read_options=csv.ReadOptions(encoding="ISO-8859-1"),
+        parse_options=csv.ParseOptions(delimiter='\t'),
+        convert_options=csv.ConvertOptions(
+            include_columns=list(CMIC_COLUMNS), strings_can_be_null=True,
+            column_types={col: types[dtype] for col, dtype in CMIC_SCHEMA.items()}))
+    # Missing text comes back as None rather than NaN
+    df = table.to_pandas()
+    for col, dtype in CMIC_SCHEMA.items():
+        if dtype is str:
+            df[col] = df[col].fillna(np.nan)
+    return df
+
+def clean_cmic_rowwise(df):
+    df.rename(columns=CMIC_COLUMNS, inplace=True)
     
         
     df = df[df['job_no'].notnull()].copy()
@@ -68,6 +277,32 @@ def clean_cmic(df):
     df['ID'] = combine_cols(df, cols_to_combine)
     
     return df
+
+def clean_cmic_vectorized(df):
+    df.rename(columns=CMIC_COLUMNS, inplace=True)
+    
+    df = df.take(np.flatnonzero(df['job_no'].notnull().to_numpy()))
+    df['co_code'] = map_unique(df['co_code'], to_numeric)
+    df['cont_or_co'] = np.where(df['co_code'] == 0, 'Contract', 'CO')
+    df['category'] = df['category']/100
+    df['co_date'] = pd.to_datetime(df['co_date'], infer_datetime_format=True)
+    df['item_name'] = map_unique(df['item_name'], lambda col: short_name(col, 30))
+    df['vendor_name'] = map_unique(df['vendor_name'], lambda col: short_name(col, 15))
+    df['phase_no'] = map_unique(df['phase_no'], pad_phase)
+    
+    cols_to_convert = ['job_no', 'vendor_no', 'item_no', 'job_cost_no', 'category']
+    
+    for col in cols_to_convert:
+        df[col] = map_unique(df[col], convert_to_str)
+    
+    df['ID'] = build_id(df, ID_COLS)
+    
+    return df
+
+def clean_cmic(df, vectorized=True):
+    if vectorized:
+        return clean_cmic_vectorized(df)
+    return clean_cmic_rowwise(df)
 ###############################################################################
 #.........................Clean up SL.........................................#
 ###############################################################################
@@ -77,13 +312,59 @@ def sl_cont_or_co(val1, val2):
     else:
         return 'CO'
 
+# Positional SL report columns used by clean_sl and the dtype each is read as.
+# Amounts are printed with thousands separators in the report
+SL_SCHEMA = {
+    20: str,     # subcontract_no, vendor_no, vendor_name
+    26: str,     # job_no, job_name
+    41: str,     # item_no
+    42: str,     # item_name, category, phase_no, job_cost_no
+    47: float,   # contract dollar_amount, compared with 48 for cont_or_co
+    48: float,
+    56: str,     # contract qty_type
+    57: float,   # contract qty
+    102: str,    # co_date
+    105: str,    # CO qty_type
+    106: float,  # CO qty
+    108: float,  # CO dollar_amount
+    128: float,  # cont_total
+    129: float,  # vendor_total
+    }
+
+def read_sl(sl_file, engine='c', chunksize=None):
+    # Only the SL_SCHEMA columns are parsed out of the 130+ in the report
+    if engine == 'pyarrow':
+        if chunksize:
+            raise ValueError("The pyarrow SL reader does not read in chunks")
+        return read_sl_pyarrow(sl_file)
+    return pd.read_csv(sl_file, header=None, usecols=list(SL_SCHEMA), 
+                       dtype=SL_SCHEMA, thousands=',', engine=engine, 
+                       chunksize=chunksize)
+
+def read_sl_pyarrow(sl_file):
+    # pyarrow is optional, so it is only imported when asked for. Its reader
+    # has no thousands option, so amounts are read as text and converted after
+    import pyarrow
+    from pyarrow import csv
+    
+    names = ['f{}'.format(col) for col in SL_SCHEMA]
+    table = csv.read_csv(
+        sl_file,
+        read_options=csv.ReadOptions(autogenerate_column_names=True),
+        convert_options=csv.ConvertOptions(
+            include_columns=names, strings_can_be_null=True,
+            column_types={name: pyarrow.string() for name in names}))
+    df = table.to_pandas()
+    df.columns = list(SL_SCHEMA)
+    return apply_sl_schema(df)
+
 def gather_co_rel_data(cont_type, cont_val, co_val):
     if cont_type== 'CO':
         return co_val
     else:
         return cont_val
 
-def clean_sl(df):
+def clean_sl_rowwise(df):
 
     #sl = pd.read_csv('sl.csv', header=None)
     #sl.dropna(how='all', axis=1, inplace=True)
@@ -128,80 +409,942 @@ def clean_sl(df):
     df['ID'] = combine_cols(df, cols_to_combine)
     
     return df
+
+# One compiled pattern per SL source column. Each field is captured inside its
+# own lookahead so a single regex pass yields every field that the row-wise
+# version gets from repeated str.split calls on the same text.
+SL_JOB_RE = re.compile(
+    r'^(?=(?:[^ ]* ){4}(?P<job_no>[^ -]*))'               # split(' ')[4].split('-')[0]
+    r'(?=.*?- (?P<job_name>.*?)(?:- |\Z))',               # split('- ')[1]
+    re.S)
+SL_CONT_RE = re.compile(
+    r'^(?=(?:[^ ]* ){3}(?P<subcontract_no>[^ ]*))'        # split(' ')[3]
+    r'(?=(?:.*?: ){2}(?P<vendor>.*?)(?:: |\Z))',          # split(': ')[2]
+    re.S)
+SL_VENDOR_RE = re.compile(
+    r'^(?=(?:[^ ]* ){2}(?P<vendor_no>[^ ]*))'             # split(' ')[2]
+    r'(?=(?:.*  )?(?P<vendor_name>.*)\Z)',                # split('  ')[-1]
+    re.S)
+
+def to_float(col):
+    if pd.api.types.is_numeric_dtype(col):
+        return col.astype(float)
+    return col.str.replace(',', '', regex=False).astype(float)
+
+def apply_sl_schema(df):
+    # Amounts still held as text, e.g. from a plain read_csv(header=None) or
+    # the pyarrow reader, are converted to floats
+    for col, dtype in SL_SCHEMA.items():
+        if dtype is float:
+            df[col] = to_float(df[col])
+    return df
+
+def strip_fields(fields):
+    return fields.apply(lambda col: col.str.strip())
+
+def parse_sl_job(text):
+    return strip_fields(text.str.extract(SL_JOB_RE))
+
+def parse_sl_cont(text):
+    cont = text.str.extract(SL_CONT_RE)
+    vendor = strip_fields(cont['vendor'].str.extract(SL_VENDOR_RE))
+    vendor['vendor_name'] = short_name(vendor['vendor_name'], 15)
+    return pd.concat([cont[['subcontract_no']], vendor], axis=1)
+
+# Item codes and descriptions are close to unique per line, so there is 
+# nothing to gain from parsing each distinct value once. They are split in a 
+# single pass with str.partition, which is several times faster than a regex 
+# or a chain of Series.str calls over the same column
+DESC_FIELDS = ['item_name', 'category', 'phase_no', 'job_cost_no']
+
+def parse_sl_item(text):
+    item_no = [x.rpartition(': ')[2].strip() if isinstance(x, str) else np.nan 
+               for x in text]                                   # split(': ')[-1]
+    return pd.DataFrame({'item_no': item_no}, index=text.index)
+
+def parse_sl_desc(text):
+    desc = [(x.partition('  ')[0].strip()[0:30].strip().lower(),  # split('  ')[0]
+             x.rpartition(': ')[2].strip(),                     # split(': ')[-1]
+             x.rpartition('Phase: ')[2].partition('  ')[0]      # split('Phase: ')[-1].split('  ')[0]
+             .strip().strip('.'),
+             x.partition('- ')[0].rpartition(' ')[2].strip())   # split('- ')[0].split(' ')[-1]
+            for x in text.astype(str)]
+    return pd.DataFrame(desc, index=text.index, columns=DESC_FIELDS)
+
+def derive_sl_fields(df):
+    # Row-local part of clean_sl: every derived field depends only on its own
+    # row, so this can also run on chunks of a file
+    df = apply_sl_schema(df)
+    
+    # Get Change Order date
+    df['cont_or_co'] = np.where(df[47] == df[48], 'Contract', 'CO')
+    df['co_date'] = pd.to_datetime(df[102], infer_datetime_format=True)
+    
+    job = map_unique(df[26], parse_sl_job)
+    cont = map_unique(df[20], parse_sl_cont)
+    item = parse_sl_item(df[41])
+    desc = parse_sl_desc(df[42])
+    
+    df['job_no'] = job['job_no']
+    df['job_name'] = job['job_name']
+    df['subcontract_no'] = cont['subcontract_no']
+    df['vendor_no'] = cont['vendor_no']
+    df['vendor_name'] = cont['vendor_name']
+    df['item_no'] = item['item_no']
+    df['item_name'] = desc['item_name']
+    df['category'] = desc['category']
+    df['phase_no'] = desc['phase_no']
+    df['job_cost_no'] = desc['job_cost_no']
+    df['co_code'] = None
+    
+    is_co = (df['cont_or_co'] == 'CO').to_numpy()
+    df['qty'] = np.where(is_co, df[106], df[57])
+    df['qty'] = df['qty'].fillna(0)
+    
+    df['qty_type'] = np.where(is_co, df[105], df[56])
+    df['qty_type'] = df['qty_type'].fillna('LS')
+    
+    df['dollar_amount'] = np.where(is_co, df[108], df[47])
+    
+    df['cont_total'] = df[128]
+    df['vendor_total'] = df[129]
+    
+    return df
+
+def select_sl_rows(df):
+    # Same rows as drop_duplicates followed by Contract rows + dated rows, but
+    # gathered with a single take instead of copying the frame each step
+    unique = ~df.duplicated([41, 42, 'cont_or_co', 'co_date']).to_numpy()
+    keep = np.concatenate([
+        np.flatnonzero(unique & (df['cont_or_co'] == 'Contract').to_numpy()),
+        np.flatnonzero(unique & df['co_date'].notnull().to_numpy())])
+    keep = keep[np.argsort(df.index.to_numpy()[keep], kind='stable')]
+    return df.take(keep)
+
+def clean_sl_vectorized(df):
+    df = select_sl_rows(derive_sl_fields(df))
+    df['ID'] = build_id(df, ID_COLS)
+    
+    return df
+
+def clean_sl(df, vectorized=True):
+    if vectorized:
+        return clean_sl_vectorized(df)
+    return clean_sl_rowwise(df)
 ###############################################################################
 #.........................Combine and Compare.................................#
 ###############################################################################
 
+COMPARE_COLS = ['job_no', 'job_name', 'subcontract_no', 'vendor_name',
+                'item_no', 'item_name', 'category', 'phase_no', 'job_cost_no', 
+                'cont_or_co', 'co_date', 'qty', 'qty_type', 'dollar_amount', 
+                'cont_total', 'vendor_total']
+
+# Absolute and relative tolerance per numeric field. Values match when 
+# |cmic - sl| <= abs + rel * max(|cmic|, |sl|), so rounding noise from the 
+# exports is not flagged. Dollar amounts are allowed half a cent
+TOLERANCES = {
+    'qty': (1e-6, 1e-9), 
+    'dollar_amount': (0.005, 1e-9), 
+    'cont_total': (0.005, 1e-9), 
+    'vendor_total': (0.005, 1e-9),
+    }
+
 def compare_cols(df, cols):
     for col in cols:
         df[col+'_zcomparison'] = df[col+'_cmic'] == df[col+'_sl']
     
     return df
 
-def compare_dfs(cmic, sl):
+def compare_numeric(df, tolerances):
+    # All numeric fields are compared at once on an (rows x fields) array. 
+    # Missing on both sides counts as a match. The signed delta is CMIC - SL
+    cols = list(tolerances)
+    cmic = df[[col+'_cmic' for col in cols]].to_numpy(dtype=float)
+    sl = df[[col+'_sl' for col in cols]].to_numpy(dtype=float)
+    atol, rtol = np.array([tolerances[col] for col in cols], dtype=float).T
+    
+    delta = cmic - sl
+    with np.errstate(invalid='ignore'):
+        close = np.abs(delta) <= atol + rtol*np.fmax(np.abs(cmic), np.abs(sl))
+    close |= np.isnan(cmic) & np.isnan(sl)
+    
+    for i, col in enumerate(cols):
+        df[col+'_zcomparison'] = close[:, i]
+        df[col+'_zdelta'] = delta[:, i]
+    
+    return df
+
+# Columns with only a handful of distinct values per job
+CATEGORICAL_COLS = ['job_no', 'vendor_name', 'category', 'phase_no', 
+                    'cont_or_co', 'qty_type']
+
+def shared_categoricals(cmic, sl, cols):
+    # Both sides get the same categories, so the merge moves integer codes 
+    # around and the comparison is a comparison of codes
+    cmic_cols = {}
+    sl_cols = {}
+    for col in cols:
+        categories = pd.concat([cmic[col], sl[col]]).dropna().unique()
+        cmic_cols[col] = pd.Categorical(cmic[col], categories=categories)
+        sl_cols[col] = pd.Categorical(sl[col], categories=categories)
+    
+    return cmic.assign(**cmic_cols), sl.assign(**sl_cols)
+
+def compare_dfs(cmic, sl, tolerances=None, categorical=False, by=[]):
     
     # Merge databases with the relevant columns
     cols_to_keep = ['job_no', 'job_name', 'subcontract_no', 'vendor_no', 'vendor_name',
                     'item_no', 'item_name', 'category', 'phase_no', 'job_cost_no', 
                     'cont_or_co', 'co_date', 'qty', 'qty_type', 'dollar_amount', 
-                    'cont_total', 'vendor_total', 'ID']
-    combined = pd.merge(cmic[cols_to_keep], sl[cols_to_keep], 
-                        how='outer', on='ID', suffixes=('_cmic', '_sl'))
+                    'cont_total', 'vendor_total', 'ID'] + by
+    cmic = cmic[cols_to_keep]
+    sl = sl[cols_to_keep]
+    with timed('merge', len(cmic) + len(sl)) as record:
+        if categorical:
+            cmic, sl = shared_categoricals(cmic, sl, CATEGORICAL_COLS)
+        combined = pd.merge(cmic, sl, how='outer', on=by+['ID'], 
+                            suffixes=('_cmic', '_sl'))
+        record['rows_out'] = len(combined)
     
-    # Compare the databases
-    cols_to_compare = ['job_no', 'job_name', 'subcontract_no', 'vendor_name',
-                    'item_no', 'item_name', 'category', 'phase_no', 'job_cost_no', 
-                    'cont_or_co', 'co_date', 'qty', 'qty_type', 'dollar_amount', 
-                    'cont_total', 'vendor_total']
+    # Compare the databases, numeric fields within tolerance
+    with timed('compare_cols', len(combined)) as record:
+        tolerances = dict(TOLERANCES, **(tolerances or {}))
+        combined = compare_cols(combined, [col for col in COMPARE_COLS 
+                                           if col not in tolerances])
+        combined = compare_numeric(combined, tolerances)
+        combined.loc[(combined['cont_or_co_sl'] == 'Contract') & (combined['cont_or_co_cmic']  == 'Contract'), 'co_date_zcomparison'] = True
+        
+        # Sort by column name
+        combined = combined.reindex(sorted(combined.columns), axis=1)
+        record['rows_out'] = len(combined)
+    
+    return combined
 
+def mismatch_mask(df):
+    # Bit i is set when COMPARE_COLS[i] differs between CMIC and SL, so a row
+    # matches on every field exactly when its mask is 0
+    mask = np.zeros(len(df), dtype=np.int64)
+    for bit, col in enumerate(COMPARE_COLS):
+        differs = ~df[col+'_zcomparison'].to_numpy(dtype=bool)
+        mask |= differs.astype(np.int64) << bit
+    return mask
+
+def mismatch_counts(mask):
+    counts = {'rows': len(mask), 'mismatched_rows': int(np.count_nonzero(mask))}
+    for bit, col in enumerate(COMPARE_COLS):
+        counts[col+'_mismatches'] = int(np.count_nonzero(mask & (1 << bit)))
+    return counts
+
+
+###############################################################################
+#.........................Write output........................................#
+###############################################################################
+
+COMPRESSIONS = {
+    'csv': ['gzip', 'bz2', 'xz'],
+    'parquet': ['snappy', 'gzip', 'brotli', 'zstd', 'lz4'],
+    'feather': ['zstd', 'lz4'],
+    }
+CSV_OPENERS = {None: open, 'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+CSV_SUFFIXES = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+
+TEXT_FIELDS = ['job_no', 'job_name', 'subcontract_no', 'vendor_no', 'vendor_name',
+               'item_no', 'item_name', 'category', 'phase_no', 'job_cost_no', 
+               'cont_or_co', 'qty_type']
+
+def output_file(loc, job_no, fmt='csv', compression=None):
+    out_file = loc+'comparison_'+job_no+'.'+fmt
+    if fmt == 'csv':
+        out_file += CSV_SUFFIXES.get(compression, '')
+    return out_file
+
+OUTPUTS = ['full', 'mismatches']
+SUMMARY = 'comparison_summary.csv'
+
+def write_comparison(write, df, output='full'):
+    # Writes the full comparison or only the rows that differ somewhere, with
+    # their mask so they can be filtered by field. Returns mismatch counts
+    with timed('write', len(df)) as record:
+        mask = mismatch_mask(df)
+        if output == 'mismatches':
+            df = df[mask != 0].assign(mismatch_mask=mask[mask != 0])
+            df = df.reindex(sorted(df.columns), axis=1)
+        write(df)
+        record['rows_out'] = len(df)
+    return mismatch_counts(mask)
+
+def write_summary(loc, summaries):
+    columns = ['rows', 'mismatched_rows'] + [col+'_mismatches' for col in COMPARE_COLS]
+    summary = pd.DataFrame.from_dict(summaries, orient='index', columns=columns)
+    summary = summary.rename_axis('job_no').sort_index()
+    summary.to_csv(loc+SUMMARY)
+    print("Mismatch summary for {0} job(s) saved to '{1}'".format(
+        len(summary), loc+SUMMARY))
+
+def typed_output(df):
+    # Text columns become pandas strings so that a column with no values in
+    # one streamed bucket still has the same type as in the others
+    text_cols = ['ID'] + [field+side for field in TEXT_FIELDS 
+                          for side in ('_cmic', '_sl')]
+    return df.astype({col: 'string' for col in text_cols if col in df})
+
+@contextmanager
+def output_writer(out_file, fmt='csv', compression=None):
+    # Yields a function that appends a comparison frame to out_file, so the
+    # streaming mode can write one bucket at a time. A failed write leaves no
+    # partial output behind
+    try:
+        if fmt == 'csv':
+            with CSV_OPENERS[compression](out_file, 'wt', newline='') as f:
+                yield csv_writer(f)
+        else:
+            with arrow_writer(out_file, fmt, compression) as write:
+                yield write
+    except BaseException:
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        raise
+
+def csv_writer(f):
+    header = [True]
+    def write(df):
+        df.to_csv(f, header=header[0], index=False)
+        header[0] = False
+    return write
+
+@contextmanager
+def arrow_writer(out_file, fmt, compression=None):
+    # Parquet and feather go through pyarrow, which is only needed for them
+    import pyarrow
+    import pyarrow.parquet
     
-    combined = compare_cols(combined, cols_to_compare)
-    combined.loc[(combined['cont_or_co_sl'] == 'Contract') & (combined['cont_or_co_cmic']  == 'Contract'), 'co_date_zcomparison'] = True
+    # The first frame fixes the schema that later frames are written with
+    writer = {}
+    def write(df):
+        table = pyarrow.Table.from_pandas(typed_output(df), preserve_index=False,
+                                          schema=writer.get('schema'))
+        if not writer:
+            writer['schema'] = table.schema
+            if fmt == 'parquet':
+                writer['file'] = pyarrow.parquet.ParquetWriter(
+                    out_file, table.schema, compression=compression or 'snappy')
+            else:
+                writer['file'] = pyarrow.ipc.new_file(
+                    out_file, table.schema, 
+                    options=pyarrow.ipc.IpcWriteOptions(compression=compression))
+        writer['file'].write_table(table)
+    try:
+        yield write
+    finally:
+        if writer:
+            writer['file'].close()
+
+
+###############################################################################
+#.........................Stream large files..................................#
+###############################################################################
+
+# Rows are bucketed on the part of the ID that is also fixed by the SL
+# duplicate key (columns 41, 42 and cont_or_co), so both the merge on ID and
+# the SL drop_duplicates only ever need one bucket in memory
+PARTITION_COLS = ['item_no', 'phase_no', 'category', 'cont_or_co']
+
+def write_partitions(df, tmp, side, chunk_no, partitions):
+    buckets = pd.util.hash_pandas_object(df[PARTITION_COLS], index=False)
+    buckets = buckets.to_numpy() % partitions
+    order = np.argsort(buckets, kind='stable')
+    bounds = np.searchsorted(buckets[order], np.arange(partitions + 1))
+    for p in range(partitions):
+        rows = order[bounds[p]:bounds[p+1]]
+        # Every bucket gets a file from the first chunk, even if empty, so
+        # that each one has the full set of columns when read back
+        if len(rows) or chunk_no == 0:
+            df.take(rows).to_pickle(
+                os.path.join(tmp, '{0}_{1}_{2}.pkl'.format(side, p, chunk_no)))
+
+def read_partition(tmp, side, p):
+    files = glob.glob(os.path.join(tmp, '{0}_{1}_*.pkl'.format(side, p)))
+    files.sort(key=lambda f: int(f.split('_')[-1].split('.')[0]))
+    return pd.concat([pd.read_pickle(f) for f in files])
+
+def stream_job(cmic_file, sl_file, out_file, engine='c', chunksize=100000, 
+               partitions=16, fmt='csv', compression=None, output='full', 
+               tolerances=None, categorical=False):
+    # Peak memory is bounded by the chunk and bucket size rather than the size
+    # of the input files. Rows come out grouped by bucket, sorted by ID within
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(out_file) or '.') as tmp:
+        with timed('partition_cmic') as record, \
+                read_cmic(cmic_file, engine, chunksize) as chunks:
+            record['rows_in'] = 0
+            for i, chunk in enumerate(chunks):
+                record['rows_in'] += len(chunk)
+                write_partitions(clean_cmic(chunk), tmp, 'cmic', i, partitions)
+        
+        with timed('partition_sl') as record, \
+                read_sl(sl_file, engine, chunksize) as chunks:
+            record['rows_in'] = 0
+            for i, chunk in enumerate(chunks):
+                record['rows_in'] += len(chunk)
+                write_partitions(derive_sl_fields(chunk), tmp, 'sl', i, partitions)
+        
+        counts = Counter()
+        with output_writer(out_file, fmt, compression) as write:
+            for p in range(partitions):
+                cmic_df = read_partition(tmp, 'cmic', p)
+                sl_df = select_sl_rows(read_partition(tmp, 'sl', p))
+                sl_df['ID'] = build_id(sl_df, ID_COLS)
+                
+                out_df = compare_dfs(cmic_df, sl_df, tolerances, categorical)
+                counts.update(write_comparison(write, out_df, output))
     
-    # Sort by column name
-    combined = combined.reindex(sorted(combined.columns), axis=1)
+    return dict(counts)
+
+
+###############################################################################
+#.........................Cleaned file cache..................................#
+###############################################################################
+
+def file_hash(file):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Cached frames are keyed on this script as well as the input file, so any
+# change to the cleaning code invalidates them
+CODE_VERSION = file_hash(__file__)
+
+def reader_key(kind, engine):
+    # Frames read by another parser or through another schema are cached 
+    # apart, even though they should come out the same
+    schema = CMIC_SCHEMA if kind.startswith('cmic') else SL_SCHEMA
+    schema = json.dumps({str(col): dtype.__name__ for col, dtype in schema.items()}, 
+                        sort_keys=True)
+    return engine+'-'+hashlib.blake2b(schema.encode(), digest_size=4).hexdigest()
+
+def load_cached(load, file, kind, cache_dir=None, cache_mb=2048, engine='c'):
+    if cache_dir is None:
+        return load()
     
-    return combined
+    key = '{0}_{1}_{2}_{3}'.format(kind, reader_key(kind, engine), file_hash(file), 
+                                   CODE_VERSION[:8])
+    path = os.path.join(cache_dir, key + '.parquet')
+    try:
+        with timed('read_cache') as record:
+            df = pd.read_parquet(path)
+            record['rows_out'] = len(df)
+        # Mark as recently used for eviction
+        os.utime(path)
+        evict_cache(cache_dir, cache_mb * 2**20)
+        # SL columns are positional integers, which parquet stores as strings
+        if kind.startswith('sl'):
+            df.columns = [int(c) if c.isdigit() else c for c in df.columns]
+        return df
+    except (FileNotFoundError, ImportError):
+        pass
+    
+    df = load()
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    columns = df.columns
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.columns = columns.map(str)
+        df.to_parquet(tmp)
+        os.replace(tmp, path)
+        evict_cache(cache_dir, cache_mb * 2**20)
+    except Exception as e:
+        # Caching is best effort, e.g. pyarrow may not be installed
+        print("Could not cache '{0}': {1}".format(file, e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    finally:
+        df.columns = columns
+    return df
+
+def evict_cache(cache_dir, max_bytes):
+    # Least recently used files go first
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*.parquet')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+###############################################################################
+#.........................Incremental runs....................................#
+###############################################################################
+
+MANIFEST = 'comparison_manifest.json'
+CHANGES = 'comparison_changes.csv'
+
+def read_manifest(loc):
+    try:
+        with open(loc+MANIFEST) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_manifest(loc, entries):
+    tmp = loc+MANIFEST+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+    os.replace(tmp, loc+MANIFEST)
+
+def write_changes(loc, status):
+    changes = pd.DataFrame(sorted(status.items()), columns=['job_no', 'status'])
+    changes.to_csv(loc+CHANGES, index=False)
+    counts = changes['status'].value_counts()
+    print("Changes since the last run: " + 
+          ", ".join("{0} {1}".format(n, s) for s, n in counts.items()))
+
+def file_fingerprint(file, previous=None):
+    stat = os.stat(file)
+    # Same path, size and modification time: trust the previous content hash
+    # rather than re-reading the whole file
+    if (previous and previous['file'] == file and 
+            previous['size'] == stat.st_size and 
+            previous['mtime'] == stat.st_mtime_ns):
+        return previous
+    return {'file': file, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 
+            'hash': file_hash(file)}
+
+def job_settings(options):
+    # Everything that can change a comparison output. The cache does not
+    settings = {k: v for k, v in options.items() if not k.startswith('cache')}
+    settings['code'] = CODE_VERSION
+    return json.dumps(settings, sort_keys=True)
+
+def plan_incremental(jobs, manifest, loc, options):
+    settings = job_settings(options)
+    
+    to_run = []
+    entries = {}
+    status = {}
+    for job in jobs:
+        job_no, cmic_file, sl_file = job
+        previous = manifest.get(job_no, {})
+        entry = {'cmic': file_fingerprint(cmic_file, previous.get('cmic')),
+                 'sl': file_fingerprint(sl_file, previous.get('sl')),
+                 'settings': settings}
+        entries[job_no] = entry
+        
+        if not previous:
+            status[job_no] = 'new'
+        elif (previous['cmic']['hash'] == entry['cmic']['hash'] and 
+              previous['sl']['hash'] == entry['sl']['hash'] and 
+              previous['settings'] == settings and 
+              os.path.exists(output_file(loc, job_no, options.get('fmt', 'csv'), 
+                                         options.get('compression')))):
+            status[job_no] = 'unchanged'
+            if 'summary' in previous:
+                entry['summary'] = previous['summary']
+            continue
+        else:
+            status[job_no] = 'changed'
+        to_run.append(job)
+    
+    for job_no in manifest:
+        if job_no not in entries:
+            status[job_no] = 'removed'
+    
+    return to_run, entries, status
 
 
 ###############################################################################
 #.........................Load files..........................................#
 ###############################################################################
 
-def file_loader(loc):
+def load_cmic(cmic_file, vectorized=True, engine='c'):
+    with timed('read_cmic') as record:
+        if vectorized:
+            cmic_df = read_cmic(cmic_file, engine)
+        else:
+            cmic_df = pd.read_table(cmic_file, encoding="ISO-8859-1")
+        record['rows_out'] = len(cmic_df)
+    with timed('clean_cmic', len(cmic_df)) as record:
+        cmic_df = clean_cmic(cmic_df, vectorized)
+        record['rows_out'] = len(cmic_df)
+    return cmic_df
+
+def load_sl(sl_file, vectorized=True, engine='c'):
+    with timed('read_sl') as record:
+        if vectorized:
+            sl_df = read_sl(sl_file, engine)
+        else:
+            sl_df = pd.read_csv(sl_file, header=None)
+        record['rows_out'] = len(sl_df)
+    with timed('clean_sl', len(sl_df)) as record:
+        sl_df = clean_sl(sl_df, vectorized)
+        record['rows_out'] = len(sl_df)
+    return sl_df
+
+def load_pair(cmic_file, sl_file, vectorized=True, engine='c', cache_dir=None, 
+              cache_mb=2048):
+    # Cached frames are reused for unchanged files
+    mode = 'vectorized' if vectorized else 'rowwise'
+    cmic_df = load_cached(lambda: load_cmic(cmic_file, vectorized, engine), 
+                          cmic_file, 'cmic_'+mode, cache_dir, cache_mb, engine)
+    sl_df = load_cached(lambda: load_sl(sl_file, vectorized, engine), 
+                        sl_file, 'sl_'+mode, cache_dir, cache_mb, engine)
+    return cmic_df, sl_df
+
+def compare_job(job_no, cmic_file, sl_file, loc, vectorized=True, engine='c', 
+                chunksize=None, partitions=16, cache_dir=None, cache_mb=2048, 
+                fmt='csv', compression=None, output='full', tolerances=None, 
+                categorical=False):
+    out_file = output_file(loc, job_no, fmt, compression)
+    if chunksize:
+        print("---------------------\n",
+             "Streaming files\n'{0}' and\n'{1}'".format(cmic_file, sl_file))
+        counts = stream_job(cmic_file, sl_file, out_file, engine, chunksize, 
+                            partitions, fmt, compression, output, tolerances, 
+                            categorical)
+        return out_file, counts
+    
+    print("---------------------\n",
+         "Comparing files\n'{0}' and\n'{1}'".format(cmic_file, sl_file))
+
+    # Load and clean up dfs for comparison
+    cmic_df, sl_df = load_pair(cmic_file, sl_file, vectorized, engine, 
+                               cache_dir, cache_mb)
+    
+    # Combine and compare
+    out_df = compare_dfs(cmic_df, sl_df, tolerances, categorical)
+    
+    # Save file
+    with output_writer(out_file, fmt, compression) as write:
+        counts = write_comparison(write, out_df, output)
+    
+    return out_file, counts
+
+def run_job(job, loc, profile=False, **options):
+    # Errors are returned rather than raised so that one bad job does not
+    # abort the rest of the batch. The job's stage records go back with the
+    # result, since a worker process cannot add to the caller's run log
+    job_no = job[0]
+    profiler = cProfile.Profile() if profile else None
+    with collect_stages(job_no) as stages:
+        try:
+            with timed('total'):
+                if profiler:
+                    profiler.enable()
+                try:
+                    out_file, counts = compare_job(*job, loc, **options)
+                finally:
+                    if profiler:
+                        profiler.disable()
+            error = None
+        except Exception as e:
+            out_file, counts = None, None
+            error = '{}: {}'.format(type(e).__name__, e)
+    
+    if error is None:
+        # Each inner stage resets the high-water mark, so the job's peak is
+        # the highest of theirs
+        stages[-1]['peak_rss_mb'] = max(record['peak_rss_mb'] for record in stages)
+    if profiler and error is None:
+        profiler.dump_stats(profile_file(loc, job_no))
+    return job_no, out_file, counts, stages, error
+
+def collect_jobs(done, n_jobs, results, summaries, run_log, errors):
+    for i, (job_no, out_file, counts, stages, error) in enumerate(done, 1):
+        run_log.extend(stages)
+        if error is None:
+            results[job_no] = out_file
+            summaries[job_no] = counts
+            print("[{0}/{1}] Job {2} saved to '{3}'".format(i, n_jobs, job_no, out_file))
+            print("      " + " | ".join("{0} {1:.2f}s".format(stage, seconds)
+                                        for stage, seconds in stage_times(stages)))
+        else:
+            errors[job_no] = error
+            print("[{0}/{1}] Job {2} FAILED: {3}".format(i, n_jobs, job_no, error))
+
+def parse_job_no(file):
+    # File names end in the job number, e.g. 'cmic 180123.txt'
+    return os.path.basename(file).split()[-1].split('.')[0]
+
+def index_files(files):
+    index = {}
+    for file in files:
+        index.setdefault(parse_job_no(file), []).append(file)
+    return index
+
+def pair_files(cmic_files, sl_files):
+    cmic_index = index_files(cmic_files)
+    sl_index = index_files(sl_files)
+    
+    jobs = []
+    problems = {}
+    for job_no, cmic_matches in sorted(cmic_index.items()):
+        sl_matches = sl_index.get(job_no, [])
+        if len(cmic_matches) > 1:
+            problems[job_no] = "Multiple CMIC files: {}".format(cmic_matches)
+        elif not sl_matches:
+            problems[job_no] = "No SL file found for '{}'".format(cmic_matches[0])
+        elif len(sl_matches) > 1:
+            problems[job_no] = "Multiple SL files: {}".format(sl_matches)
+        else:
+            jobs.append((job_no, cmic_matches[0], sl_matches[0]))
+    
+    for job_no, sl_matches in sorted(sl_index.items()):
+        if job_no not in cmic_index:
+            problems[job_no] = "No CMIC file found for {}".format(sl_matches)
+    
+    return jobs, problems
+
+def file_loader(loc, workers=1, incremental=False, program=False, profile=False, 
+                **options):
     cmic_files = glob.glob(loc+'cmic'+'*.*')
     sl_files = glob.glob(loc+'sl'+'*.*')
     
-    for cmic_file in cmic_files:
-        job_no = cmic_file.split()[-1].split('.')[0]
-        
-        # Get the relevant SL file
-        sl_file = [s for s in sl_files if job_no in s][0]
-        
-        # Load files
-        cmic_df = pd.read_table(cmic_file, encoding="ISO-8859-1")
-        sl_df = pd.read_csv(sl_file, header=None)
-        
-        print("---------------------\n",
-             "Comparing files\n'{0}' and\n'{1}'".format(cmic_file, sl_file))
+    # Pair files by job number before any heavy loading
+    jobs, errors = pair_files(cmic_files, sl_files)
+    results = {}
+    summaries = {}
+    run_log = []
     
-        # Clean up dfs for comparison
-        cmic_df = clean_cmic(cmic_df)
-        sl_df = clean_sl(sl_df)
-        
-        # Combine and compare
-        out_df = compare_dfs(cmic_df, sl_df)
-        
-        # Save file
-        out_df.to_csv(loc+'comparison_'+job_no+'.csv', index=False)
+    print("Found {0} job pair(s) to compare".format(len(jobs)))
+    for job_no, problem in sorted(errors.items()):
+        print("  Skipping job {0}: {1}".format(job_no, problem))
+    
+    # Only re-run jobs whose inputs changed since the last incremental run
+    if incremental:
+        manifest = read_manifest(loc)
+        jobs, entries, status = plan_incremental(jobs, manifest, loc, options)
+        for job_no, job_status in sorted(status.items()):
+            if job_status == 'unchanged':
+                results[job_no] = output_file(loc, job_no, options.get('fmt', 'csv'), 
+                                              options.get('compression'))
+                if 'summary' in entries[job_no]:
+                    summaries[job_no] = entries[job_no]['summary']
+        print("{0} job(s) unchanged since the last run, {1} to compare".format(
+            len(results), len(jobs)))
+    
+    # Job pairs are independent, so they can be spread over a process pool
+    if program:
+        compare_program(jobs, loc, results, summaries, run_log, errors, workers, 
+                        **options)
+    elif workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_job, job, loc, profile, **options) 
+                       for job in jobs]
+            done = (future.result() for future in as_completed(futures))
+            collect_jobs(done, len(jobs), results, summaries, run_log, errors)
+    else:
+        done = (run_job(job, loc, profile, **options) for job in jobs)
+        collect_jobs(done, len(jobs), results, summaries, run_log, errors)
+    
+    if incremental:
+        for job_no in errors:
+            entries.pop(job_no, None)
+            status[job_no] = 'failed'
+        for job_no, counts in summaries.items():
+            entries[job_no]['summary'] = counts
+        write_manifest(loc, entries)
+        write_changes(loc, status)
+    
+    if summaries:
+        write_summary(loc, summaries)
+    if run_log:
+        write_run_log(loc, run_log)
+    if profile:
+        keep_slowest_profile(loc, run_log)
+    
+    return results, errors
+
+
+###############################################################################
+#.........................Program-wide comparison.............................#
+###############################################################################
+
+PROGRAM_DIR = 'comparison_program'
+
+def load_job(job, **options):
+    job_no, cmic_file, sl_file = job
+    with collect_stages(job_no) as stages:
+        try:
+            cmic_df, sl_df = load_pair(cmic_file, sl_file, **options)
+            error = None
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+    if error is not None:
+        return job_no, None, None, stages, error
+    return (job_no, cmic_df.assign(job=job_no), sl_df.assign(job=job_no), 
+            stages, None)
+
+def compare_program(jobs, loc, results, summaries, run_log, errors, workers=1, 
+                    vectorized=True, engine='c', cache_dir=None, cache_mb=2048, 
+                    fmt='csv', compression=None, output='full', tolerances=None, 
+                    categorical=False, **options):
+    # All jobs are cleaned, tagged with their job number and compared in a
+    # single merge. The result is one dataset under PROGRAM_DIR with a 
+    # job=<job_no> directory per job, which pyarrow and Spark read as a 
+    # partitioned table
+    load = partial(load_job, vectorized=vectorized, engine=engine, 
+                   cache_dir=cache_dir, cache_mb=cache_mb)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            loaded = list(pool.map(load, jobs))
+    else:
+        loaded = [load(job) for job in jobs]
+    
+    cmic_dfs = []
+    sl_dfs = []
+    for job_no, cmic_df, sl_df, stages, error in loaded:
+        run_log.extend(stages)
+        if error is None:
+            cmic_dfs.append(cmic_df)
+            sl_dfs.append(sl_df)
+        else:
+            errors[job_no] = error
+            print("Job {0} FAILED: {1}".format(job_no, error))
+    del loaded
+    if not cmic_dfs:
+        return
+    
+    print("---------------------\n",
+          "Comparing {} job(s) in one merge".format(len(cmic_dfs)))
+    with collect_stages('program') as stages:
+        combined = compare_dfs(pd.concat(cmic_dfs, ignore_index=True), 
+                               pd.concat(sl_dfs, ignore_index=True), 
+                               tolerances, categorical, by=['job'])
+    run_log.extend(stages)
+    del cmic_dfs, sl_dfs
+    
+    # Write next to the old dataset and swap it in once every job is written
+    dataset = loc+PROGRAM_DIR
+    tmp = tempfile.mkdtemp(prefix=PROGRAM_DIR+'.', dir=loc or '.')
+    try:
+        parts = {}
+        for job_no, job_df in combined.groupby('job', sort=True):
+            part = os.path.join(tmp, 'job='+job_no)
+            os.mkdir(part)
+            with collect_stages(job_no) as stages, \
+                    output_writer(output_file(part+os.sep, job_no, fmt, compression), 
+                                  fmt, compression) as write:
+                summaries[job_no] = write_comparison(
+                    write, job_df.drop(columns='job'), output)
+            run_log.extend(stages)
+            parts[job_no] = output_file(os.path.join(dataset, 'job='+job_no)+os.sep, 
+                                        job_no, fmt, compression)
+        if os.path.exists(dataset):
+            shutil.rmtree(dataset)
+        os.replace(tmp, dataset)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    
+    for i, (job_no, part) in enumerate(sorted(parts.items()), 1):
+        results[job_no] = part
+        print("[{0}/{1}] Job {2} saved to '{3}'".format(i, len(parts), job_no, part))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'location of CMIC and SL files')
     parser.add_argument('location', help='enter the location')
+    parser.add_argument('--rowwise', action='store_true',
+                        help='clean files with the original row-by-row code')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of job pairs to compare in parallel')
+    parser.add_argument('--engine', choices=['c', 'pyarrow'], default='c',
+                        help='CSV parser used to read CMIC and SL files')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream files in chunks of this many rows, for '
+                        'files larger than memory')
+    parser.add_argument('--partitions', type=int, default=16,
+                        help='number of on-disk buckets used when streaming')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always re-read and re-clean every file')
+    parser.add_argument('--cache-dir', default=None,
+                        help='where cleaned files are cached '
+                        '(default: <location>.clean_cache)')
+    parser.add_argument('--cache-size', type=int, default=2048,
+                        help='cache size limit in MB')
+    parser.add_argument('--format', dest='fmt', choices=list(COMPRESSIONS), 
+                        default='csv', help='file format of the comparison output')
+    parser.add_argument('--compression', default=None,
+                        help='output compression: gzip, bz2 or xz for csv; '
+                        'snappy, gzip, brotli, zstd or lz4 for parquet; zstd or '
+                        'lz4 for feather (uncompressed feather can be memory '
+                        'mapped)')
+    parser.add_argument('--output', choices=OUTPUTS, default='full',
+                        help="'mismatches' writes only rows that differ on at "
+                        "least one field, with a bitmask of the differing fields")
+    parser.add_argument('--tolerance', action='append', default=[],
+                        metavar='FIELD=ABS[,REL]',
+                        help='absolute and optional relative tolerance for a '
+                        'numeric field, e.g. dollar_amount=0.01 (defaults: {})'
+                        .format(', '.join('{0}={1[0]:g},{1[1]:g}'.format(k, v)
+                                          for k, v in TOLERANCES.items())))
+    parser.add_argument('--categorical', action='store_true',
+                        help='merge and compare low-cardinality text columns '
+                        'as categoricals, which uses less memory on large jobs')
+    parser.add_argument('--program', action='store_true',
+                        help='compare all jobs in one merge and write a single '
+                        'dataset partitioned by job to <location>{}'.format(PROGRAM_DIR))
+    parser.add_argument('--profile', action='store_true',
+                        help='profile every job and keep the cProfile stats of '
+                        'the slowest one in comparison_<job_no>.prof')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip jobs whose files have not changed since '
+                        'the last incremental run')
     args = parser.parse_args()
+    if args.compression not in COMPRESSIONS[args.fmt] + [None]:
+        parser.error('--compression for {0} must be one of {1}'.format(
+            args.fmt, ', '.join(COMPRESSIONS[args.fmt])))
+    tolerances = {}
+    for tolerance in args.tolerance:
+        field, _, values = tolerance.partition('=')
+        if field not in TOLERANCES:
+            parser.error('--tolerance field must be one of ' + 
+                         ', '.join(TOLERANCES))
+        try:
+            values = [float(v) for v in values.split(',')]
+        except ValueError:
+            parser.error('--tolerance values must be numbers: ' + tolerance)
+        tolerances[field] = (values + [TOLERANCES[field][1]])[:2]
+    if args.program and (args.chunksize or args.incremental or args.profile):
+        parser.error('--program cannot be combined with --chunksize, '
+                     '--incremental or --profile')
+    if args.chunksize and (args.rowwise or args.engine == 'pyarrow'):
+        parser.error('--chunksize cannot be combined with --rowwise or '
+                     '--engine pyarrow')
     
     loc = args.location
-    file_loader(loc)
+    cache_dir = None if args.no_cache else (args.cache_dir or loc+'.clean_cache')
+    results, errors = file_loader(loc, workers=args.workers, 
+                                  vectorized=not args.rowwise, 
+                                  engine=args.engine, 
+                                  chunksize=args.chunksize, 
+                                  partitions=args.partitions, 
+                                  cache_dir=cache_dir, 
+                                  cache_mb=args.cache_size, 
+                                  fmt=args.fmt, 
+                                  compression=args.compression, 
+                                  output=args.output, 
+                                  tolerances=tolerances, 
+                                  categorical=args.categorical, 
+                                  incremental=args.incremental, 
+                                  program=args.program, 
+                                  profile=args.profile)
+    if errors:
+        print("===================================================\n",
+              "{} job(s) could not be compared:".format(len(errors)))
+        for job_no, error in sorted(errors.items()):
+            print("  {0}: {1}".format(job_no, error))
     print("===================================================\n",
           "All done! Comparison files stored in: '{}'".format(loc))
-
@@ -32,21 +32,77 @@
 #     - Update "master" / "combined" files to be smart enough to know if column
 #       placements change (so columns in the month-specific file are properly
 #       appended to columns in the master (or combined) table
+#
+# Run without arguments, the script asks for the AO file and output folder.
+# Given files or a config file, it loads them one after the other without
+# asking anything, e.g. for a scheduled overnight load:
+#     python SQL_AO_DB_Connect_workspace.py AO_*.xlsx --out-dir ao_csv
+#     python SQL_AO_DB_Connect_workspace.py --config ao_queue.json
 """
 
 ###############################################################################
 # Load libraries and modules #
 ###############################################################################
+import argparse
 import datetime
 import os
 import re
 import random
+import sys
+import time
 import tkinter
 import tkinter.filedialog
-import sqlalchemy
 import pandas as pd
 import numpy as np
-import pyodbc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from batch_queue import file_date, read_queue, run_queue
+from excel_readers import open_workbook
+from sql_connection import configure, get_engine, is_transient
+from sql_schema import typed_frame
+from sql_upload import append_master, upload_frame
+
+
+# Engine used to read xlsx files, see excel_readers.py. None picks the
+# fastest one installed
+EXCEL_ENGINE = None
+
+# Raw sheets are cached here as Parquet, keyed by workbook content and sheet,
+# so reruns on the same workbook skip Excel parsing. Entries unused for
+# EXCEL_CACHE_DAYS, and the oldest beyond EXCEL_CACHE_MB, are evicted. None
+# turns the cache off
+EXCEL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.excel_cache')
+EXCEL_CACHE_DAYS = 30
+EXCEL_CACHE_MB = 2048
+
+# How frames are inserted into the SQL database, see sql_upload.py. None
+# picks the strategy for the database and the default batch size. The copy
+# strategy stages its files in UPLOAD_STAGE_DIR, which SQL Server must be
+# able to read
+UPLOAD_STRATEGY = None
+UPLOAD_BATCH_SIZE = None
+UPLOAD_STAGE_DIR = None
+
+# Column types of every uploaded sheet, kept as JSON files here so that each
+# monthly table gets the same compact types (see sql_schema.py)
+SQL_TYPES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'sql_types')
+
+# Sheets uploaded at once, each over its own pooled connection, and how often
+# a sheet is tried when the server drops or times out. Retries wait
+# UPLOAD_RETRY_SECONDS, doubling each time
+UPLOAD_WORKERS = 4
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_SECONDS = 5
+
+# Every upload is also added to its master table, replacing rows an earlier
+# load of the same sourcefile date left there (see sql_upload.append_master)
+APPEND_TO_MASTER = True
+
+# Options of an unattended load and their defaults. A config file or a queue
+# entry may set any of these. sheets=None imports every sheet but the hidden
+# ones, and upload=False only saves the sheets as csv files
+BATCH_DEFAULTS = {'sheets': None, 'out_dir': '.', 'workers': None,
+                  'upload': False}
 
 
 ###############################################################################
@@ -54,46 +110,53 @@ import pyodbc
 ###############################################################################
 def connect_sql():
     """
-    SQL server details. Returns connection to the server
+    Returns connection to the server, taken from the shared connection pool;
+    closing it hands it back. The server is configured in sql_connection.py
 
     Because we have defined our server as DSN, we use "trusted source"
     credentialing, but there are other ways to do this, if necessary.
     """
+    return get_engine().connect()
 
-    # Define SQL server details
-    SERVER = 'SFSVMSQL3'
-    DATABASE = 'PGE_SIP'
-    DSN = 'PGE_SIP'
-
-    # Connect to servers
-    return pyodbc.connect('DSN='+DSN+';SERVER='+SERVER+';DATABASE='+DATABASE+';')
 
-
-def get_AO_file():
+def get_AO_file(path=None, sheets=None):
     """
     Opens up a dialog box to ask the user to select the appropriate AO file.
-    All sheets are imported from the AO source file.
+    All sheets are imported from the AO source file, unless sheets names the
+    ones to import. Returns the file path, sheet names and file date.
 
-    Note: User input is required
+    Note: User input is required, unless the path is given
     """
-    root = tkinter.Tk()
+    if path is None:
+        root = tkinter.Tk()
 
-    # Ask the user to select the appropriate AO file
-    print("Please choose the AO source file that you'd like to import")
-    srcfile = tkinter.filedialog.askopenfile(parent=root, mode='rb', title="")
-    root.destroy()
+        # Ask the user to select the appropriate AO file
+        print("Please choose the AO source file that you'd like to import")
+        srcfile = tkinter.filedialog.askopenfile(parent=root, mode='rb',
+                                                 title="")
+        root.destroy()
+        path = srcfile.name
+        srcfile.close()
 
     print("\nRegistering AO source file. May take a few minutes...\n")
 
-    # Convert to a panda dataframe
-    XL_AO = pd.ExcelFile(srcfile)
+    # Only the sheet names are needed here, the sheets are parsed later
+    XL_AO = open_workbook(path, EXCEL_ENGINE, EXCEL_CACHE_DIR,
+                          EXCEL_CACHE_DAYS, EXCEL_CACHE_MB)
     sheetnames = list(XL_AO.sheet_names)
     print("Available sheets {}".format(sheetnames))
 
-    # Remove hidden sheets
-    for name in sheetnames:
-        if 'hidden' in name:
-            sheetnames.remove(name)
+    if sheets is not None:
+        missing = [name for name in sheets if name not in sheetnames]
+        if missing:
+            raise ValueError("Sheets {} do not exist in {}".format(missing,
+                                                                   path))
+        sheetnames = list(sheets)
+    else:
+        # Remove hidden sheets
+        for name in sheetnames:
+            if 'hidden' in name:
+                sheetnames.remove(name)
 
     # Unlike D1000 file, need all sheets here, except for the hidden sheet,
     # so all sheets will be imported
@@ -103,12 +166,7 @@ def get_AO_file():
     # Load file into a pandas frame for all relevant AO sheets
     # df = pd.read_excel(io=AO_sourcefile, sheet_name=AO_sheetnames)
 
-    # Get date of the data file assuming that date is always in MMDDYYYY
-    # format at the end of the file name
-    dbdate_s = re.sub('.xlsx'r'\'>|.xls'r'\'>', '', str(srcfile))
-    dbdate_s = dbdate_s[len(dbdate_s)-8: len(dbdate_s)]
-
-    return(srcfile, sheetnames, dbdate_s)
+    return(path, sheetnames, file_date(path))
 
 
 def del_blank_cols(df):
@@ -271,21 +329,83 @@ def rename_cols(df_THISFILE):
     return df_THISFILE
 
 
-def save_db(dict_of_AO_db, sheetnames, date_of_db):
+# Workbook opened by open_AO_workbook in the current process
+AO_WORKBOOK = None
+
+
+def open_AO_workbook(path, engine=None, cache_dir=None):
+    """
+    Opens the AO workbook once per process, so that every sheet parsed in
+    that process reuses it instead of re-opening and re-reading the file.
+    With a cache_dir, sheets already cached there are loaded from the cache
+    """
+    global AO_WORKBOOK
+    AO_WORKBOOK = open_workbook(path, engine, cache_dir, EXCEL_CACHE_DAYS,
+                                EXCEL_CACHE_MB)
+
+
+def parse_AO_sheet(sheet):
+    """
+    Parses one sheet of the open AO workbook and cleans up its column names.
+    Runs in a worker process when sheets are read in parallel
+    """
+    print('\nWorking on ' + sheet + '...')
+    df_AO = AO_WORKBOOK.parse(sheet_name=sheet, header=None)
+    return sheet, rename_cols(df_AO)
+
+
+def read_AO_sheets(path, sheetnames, workers=None, engine=None,
+                   cache_dir=None):
+    """
+    Reads all AO sheets into a dictionary of well-formatted dataframes named
+    'df_' + sheet name, in sheet order.
+
+    Sheets are parsed concurrently in a process pool, each worker opening the
+    workbook once. By default there is one worker per sheet, up to the number
+    of CPUs; workers=1 parses the sheets one after the other. engine is the
+    xlsx reader and cache_dir the raw sheet cache, see excel_readers.py
+    """
+    if workers is None:
+        workers = min(len(sheetnames), os.cpu_count() or 1)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=open_AO_workbook,
+                                 initargs=(path, engine,
+                                           cache_dir)) as pool:
+            parsed = list(pool.map(parse_AO_sheet, sheetnames))
+    else:
+        open_AO_workbook(path, engine, cache_dir)
+        parsed = [parse_AO_sheet(sheet) for sheet in sheetnames]
+
+    dict_of_AO_db = {}
+    for sheet, df_AO in parsed:
+        dict_of_AO_db['df_' + sheet] = df_AO
+        print(sheet + ' completed!')
+
+    return dict_of_AO_db
+
+
+def save_db(dict_of_AO_db, sheetnames, date_of_db, out_dir=None):
     """
     Saves output file(s) on local drive to QA/QC, verify code works and if
     the SQL db already contains the db. In this case, instead of appending
     a duplicate copy, copy is stored on local drive.
+
+    The user is asked for the folder unless out_dir is given
     """
 
-    root = tkinter.Tk()
+    if out_dir is None:
+        root = tkinter.Tk()
 
-    print("\n\n********************************************************\n"
-          "Please choose the folder to store the output file in\n")
-    os.chdir(tkinter.filedialog.askdirectory(parent=root))
-    root.destroy()
+        print("\n\n********************************************************\n"
+              "Please choose the folder to store the output file in\n")
+        out_dir = tkinter.filedialog.askdirectory(parent=root)
+        root.destroy()
+    os.makedirs(out_dir, exist_ok=True)
 
-    print("Okay! Output AO files will be stored in {}\n".format(os.getcwd()))
+    print("Okay! Output AO files will be stored in {}\n".format(
+        os.path.abspath(out_dir)))
 
     for sheet in sheetnames:
         print(sheet)
@@ -296,96 +416,162 @@ def save_db(dict_of_AO_db, sheetnames, date_of_db):
         name_of_db = re.sub(" ", "", dfname + '_' + str(date_of_db) + '.csv')
 
         print("Output file {} being created...\n".format(name_of_db))
-        df.to_csv(name_of_db, index=False)
+        df.to_csv(os.path.join(out_dir, name_of_db), index=False)
 
 
-def upload_ao_sheets(dict_of_AO_db, sheetnames, date_of_db):
+def upload_ao_sheet(df, sheet, name_of_db, name_of_master=None,
+                    date_of_db=None):
+    """
+    Uploads one cleaned sheet to its own table and, with a name_of_master,
+    appends it to that master table as sourcefile date date_of_db. Columns
+    get the types kept for the sheet (see sql_schema.typed_frame). Transient
+    failures (see is_transient) are retried up to UPLOAD_ATTEMPTS times. The
+    table is replaced and the master's rows for the date are replaced on
+    every attempt, so a retry never duplicates rows.
+
+    Returns the number of attempts made, the master append status (see
+    append_master) and the error that ended the last attempt, or None. A
+    sheet that cannot be typed, e.g. because date_of_db is not MMDDYYYY or
+    its types file is broken, fails after 0 attempts
+    """
+    status = ''
+    try:
+        df, dtype = typed_frame(df.assign(sourcefile_date=date_of_db),
+                                'AO_' + sheet, SQL_TYPES_DIR)
+    except Exception as e:
+        return 0, status, e
+
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            upload_frame(df.drop(columns='sourcefile_date'), name_of_db,
+                         get_engine(), if_exists='replace', dtype=dtype,
+                         strategy=UPLOAD_STRATEGY,
+                         batch_size=UPLOAD_BATCH_SIZE,
+                         stage_dir=UPLOAD_STAGE_DIR)
+            if name_of_master is not None:
+                status = append_master(
+                    df, name_of_master, get_engine(), dtype=dtype,
+                    strategy=UPLOAD_STRATEGY, batch_size=UPLOAD_BATCH_SIZE,
+                    stage_dir=UPLOAD_STAGE_DIR)
+            return attempt, status, None
+        except Exception as e:
+            if attempt == UPLOAD_ATTEMPTS or not is_transient(e):
+                return attempt, status, e
+            wait = UPLOAD_RETRY_SECONDS * 2 ** (attempt - 1)
+            print("Upload of {} failed ({}), retrying in {} seconds".format(
+                name_of_db, e.__class__.__name__, wait))
+            time.sleep(wait)
+
+
+def upload_ao_sheets(dict_of_AO_db, sheetnames, date_of_db, out_dir=None,
+                     workers=None):
     """
     Upload cleaned AO financial sheets to SQL database
 
     Note: pyodbc does not interface directly with Microsoft SQL for uploads, so
     "sqlalchemy" is used here to bridge the gap.
 
-    The upload currently takes 200 - 400 seconds, but can be made much faster
-    with some tweaking or use of "turbodc" package
+    Rows are inserted in bulk with UPLOAD_STRATEGY (see sql_upload.py)
+    rather than one round trip per row, which took 200 - 400 seconds. Every
+    sheet goes to its own table, so up to workers (default UPLOAD_WORKERS)
+    sheets are uploaded at once over the shared connection pool. With
+    APPEND_TO_MASTER, each sheet is then appended to its master table,
+    replacing rows an earlier load of date_of_db left there. Columns are
+    stored with the compact types kept for each sheet in SQL_TYPES_DIR (see
+    sql_schema.py) rather than FLOAT and NVARCHAR(max). A sheet whose
+    upload fails is saved to out_dir instead (see save_db), without affecting
+    the others.
+
+    Returns a dataframe with the outcome of every sheet
     """
 
-    # Create MSSQL engine using Windows authentication and DSN as defined above
-    # This will serve as our connection for "df.to_sql"
-
-    try:
-        DSN = 'PGE_SIP'
-        mssql_engine = sqlalchemy.create_engine('mssql+pyodbc://'+DSN,
-                                                encoding="latin1", echo=False)
-
-        for sheet in sheetnames:
-            # send it
-            print(sheet)
-            dfname = 'df_' + sheet
-            # create dataframe wherein column types are classified automatically
-            df = dict_sheetdfs[dfname].infer_objects()
-            name_of_db = re.sub(" ", "", dfname + '_' + str(date_of_db) + '_DEVEXAMPLE')
-
-            print("Uploading {} to SQL server. Please wait...".format(name_of_db))
-            df.to_sql(name=name_of_db, con=mssql_engine, if_exists='replace')
-
-    except:
+    def upload(sheet):
+        dfname = 'df_' + sheet
+        # create dataframe wherein column types are classified automatically
+        df = dict_of_AO_db[dfname].infer_objects()
+        name_of_db = re.sub(" ", "", dfname + '_' + str(date_of_db) + '_DEVEXAMPLE')
+        name_of_master = None
+        if APPEND_TO_MASTER:
+            name_of_master = re.sub(" ", "", dfname + '_MASTER_DELETEME')
+
+        print("Uploading {} to SQL server. Please wait...".format(name_of_db))
+        start = time.perf_counter()
+        attempts, master, error = upload_ao_sheet(df, sheet, name_of_db,
+                                                  name_of_master, date_of_db)
+        return {'sheet': sheet, 'table': name_of_db, 'rows': len(df),
+                'attempts': attempts, 'master': master,
+                'seconds': time.perf_counter() - start,
+                'error': '' if error is None else '{}: {}'.format(
+                    error.__class__.__name__, error)}
+
+    # The shared, pooled engine (see sql_connection.py) will serve as our
+    # connection for the upload, one pooled connection per worker
+    workers = min(workers or UPLOAD_WORKERS, len(sheetnames)) or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        report = pd.DataFrame(list(pool.map(upload, sheetnames)),
+                              columns=['sheet', 'table', 'rows', 'attempts',
+                                       'master', 'seconds', 'error'])
+
+    report['uploaded'] = report['error'] == ''
+    print(report[['sheet', 'rows', 'attempts', 'master', 'seconds',
+                  'uploaded']].to_string(index=False))
+
+    failed = list(report.loc[~report['uploaded'], 'sheet'])
+    if failed:
+        for sheet, error in zip(failed, report.loc[~report['uploaded'], 'error']):
+            print("{}: {}".format(sheet, error))
         print("\n\n*************************************\n"
-              "Could not connect/write to SQL server. \n"
-              "Saving to local machine for now..."
-              "\n\n*************************************\n")
-        save_db(dict_of_AO_db, sheetnames, date_of_db)
+              "Could not connect/write {} sheet(s) to SQL server. \n"
+              "Saving them to local machine for now..."
+              "\n\n*************************************\n".format(len(failed)))
+        save_db(dict_of_AO_db, failed, date_of_db, out_dir)
 
-    """
-    THIS WHOLE THING NEEDS TO BE FIXED 
+    return report
 
 
-    # Append this month's data to master database
-    name_of_masterdb_in_SQL = dfname + '_MASTER_DELETEME'
-
-    # Note: Can probably be made faster with some tweaking or turbodbc" package
-    df.to_sql(name=name_of_db_in_SQL, con=mssql_engine,
-              if_exists='replace', chunksize=10**3)
+def load_AO(path=None, sheets=None, out_dir=None, workers=None,
+            upload=False):
+    """
+    Imports the sheets of one AO file, cleans them and saves them as csv
+    files, or uploads them to the SQL database with upload. Returns the
+    dictionary of cleaned sheets. Anything not given is asked for; workers
+    is as in read_AO_sheets. Raises a RuntimeError if any sheet could not be
+    uploaded, after all sheets were tried and the failed ones saved as csv
+    files (see upload_ao_sheets)
+    """
+    # Produce AO sourcefile and AO sheet names
+    AO_sourcefile, AO_sheets, dbdate = get_AO_file(path, sheets)
+
+    # note, this took ~6-7 minutes to run when every sheet re-read the workbook
+    start = datetime.datetime.now()
+
+    # Parse all sheets in parallel, create a well-formatted dataframe for
+    # each, and collect them in a dictionary with an appropriate name
+    dict_sheetdfs = read_AO_sheets(AO_sourcefile, AO_sheets, workers=workers,
+                                   engine=EXCEL_ENGINE,
+                                   cache_dir=EXCEL_CACHE_DIR)
+    sheetnumba = len(dict_sheetdfs)
+
+    failed = []
+    if upload:
+        # Sheets that cannot be uploaded are saved as csv instead
+        report = upload_ao_sheets(dict_sheetdfs, AO_sheets, dbdate, out_dir)
+        failed = list(report.loc[~report['uploaded'], 'sheet'])
+    else:
+        # Save as csv to reduce future time in dev work
+        save_db(dict_sheetdfs, AO_sheets, dbdate, out_dir)
 
     # print out how long the process took
     end = datetime.datetime.now()
-    print(end - start)
-
-    # Add current month to master list, while being wary of duplication
-
-    # CHECK into column order during master append.
-    # Does this month's column order match or allign with the master?
-    # If a new column needs to be added, will it do so automatically?
-
-    # reconnect to server
-    conn = connect_sql()
-
-    # read the full set of sourcefile dates that have already been entered
-    ao_master_sourcefiledate_excerpt = pd.read_sql('Select sourcefile_date from dbo.df_DB1000_MASTER_DELETEME', conn)
-    conn.close()
-
-    # ### Appending data to master datatable
-    # only if this months sourcefile date does not already exist
-    # ASSUMPTION: only one sourcefile per sourcefile date
-    if dbdate not in list(set(ao_master_sourcefiledate_excerpt.iloc[:, 0])):
-        # Time this process -- takes ~ 200 - 400 seconds
-        start = datetime.datetime.now()
-
-        # ## Append this month's data to master database
-        name_of_masterdb_in_SQL = 'df_DB1000_MASTER_DELETEME'
-        # ## This can be made much faster with some tweaking
-        df.to_sql(name=name_of_masterdb_in_SQL,
-                  con=mssql_engine,
-                  # change to 'replace' if starting from scratch
-                  if_exists='append')
-        end = datetime.datetime.now()
-        print(end - start)
-    else:
-        print("NOTE: It looks like " + name_of_db_in_SQL + " has already been "
-              "appended to its master.\n"
-              "A copy of the file will be stored locally for your review.")
-        save_db(df, dbdate)
-    """
+    print('Process length: ' + str(end-start) + '\n' +
+          str(sheetnumba) + ' sheets completed.')
+
+    if failed:
+        raise RuntimeError("Upload of AO {} failed for {} of {} sheets, saved "
+                           "locally instead: {}".format(dbdate, len(failed),
+                                                        sheetnumba, failed))
+    return dict_sheetdfs
+
 
 ###############################################################################
 # Main #
@@ -410,35 +596,54 @@ def upload_ao_sheets(dict_of_AO_db, sheetnames, date_of_db):
 # Example of what we are trying to achieve
 # example()
 
-# Produce AO sourcefile and AO sheet names
-AO_sourcefile, AO_sheets, dbdate = get_AO_file()
-
-# note, this takes ~6-7 minutes to run
-start = datetime.datetime.now()
-
-# Loop through all sheets, create a well-formatted dataframe, then append
-# to a dictionary with an appropriate name
-dict_sheetdfs = {}
-sheetnumba = 0
-for sht in AO_sheets:
-    print('\nWorking on ' + sht + '...')
-    sheetnumba += 1
-
-    df_AO = pd.read_excel(io=AO_sourcefile, sheet_name=sht, header=None)
-    df_AO = rename_cols(df_AO)
-
-    # add to dictionary
-    dict_sheetdfs['df_' + sht] = df_AO.copy()
-    print(sht + ' completed!')
-
-# temporary: ultimately move it to upload SQL function as an error exception
-# Save as csv to reduce future time in dev work
-save_db(dict_sheetdfs, AO_sheets, dbdate)
-
-# print out how long the process took
-end = datetime.datetime.now()
-print('Process length: ' + str(end-start) + '\n' +
-      str(sheetnumba) + ' sheets completed.')
+# Worker processes re-import this script, so only the parent process may run
+# the main code
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='clean AO files and save their sheets as csv files')
+    parser.add_argument('files', nargs='*',
+                        help='AO files or glob patterns to load one after the '
+                        'other without asking anything. Without files or '
+                        '--config, the file and folder are asked for')
+    parser.add_argument('--config', default=None,
+                        help='JSON file with a "files" list and any of '
+                        '"sheets", "out_dir", "workers" and "upload" for all '
+                        'of them')
+    parser.add_argument('--sheet', dest='sheets', action='append',
+                        default=None,
+                        help='sheet to import, may be repeated (default: all '
+                        'sheets but the hidden ones)')
+    parser.add_argument('--out-dir', default=None,
+                        help='folder to store the csv files in (default: the '
+                        'current folder)')
+    parser.add_argument('--upload', action='store_true', default=None,
+                        help='upload the sheets to the SQL database, saving '
+                        'only those that fail as csv files')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes parsing sheets (default: one per '
+                        'sheet, up to the number of CPUs)')
+    parser.add_argument('--db-url', default=None,
+                        help='SQLAlchemy URL of the database (default: the '
+                        'PGE_SIP DSN, see sql_connection.py)')
+    parser.add_argument('--db-config', default=None,
+                        help='JSON file with the database "url" and engine '
+                        'options')
+    args = parser.parse_args()
+    configure(args.db_url, args.db_config)
+
+    if args.files or args.config:
+        queue = read_queue(BATCH_DEFAULTS, args.config, args.files,
+                           sheets=args.sheets, out_dir=args.out_dir,
+                           workers=args.workers, upload=args.upload)
+        failed = run_queue(queue, load_AO)
+        print("\n{} of {} files loaded".format(len(queue) - len(failed),
+                                               len(queue)))
+        if failed:
+            print("Failed: {}".format(failed))
+            sys.exit(1)
+    else:
+        # Ask for the file and output folder
+        dict_sheetdfs = load_AO(upload=args.upload)
 
 # Use date in the source file name as a suffix.
 # Can be tailored to fit based on user input, today's date, etc. 
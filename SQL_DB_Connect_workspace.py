@@ -32,20 +32,68 @@
 #     - Update "master" / "combined" files to be smart enough to know if column
 #       placements change (so columns in the month-specific file are properly
 #       appended to columns in the master (or combined) table
+#
+# Run without arguments, the script asks for the D1000 file, sheet and output
+# folder. Given files or a config file, it loads them one after the other
+# without asking anything, e.g. for a scheduled overnight load. The detected
+# milestone names cannot be checked by anyone then, so batch loads must accept
+# them up front with --confirm-milestones or "confirm": true in the config:
+#     python SQL_DB_Connect_workspace.py D1000_*.xlsx --confirm-milestones
+#     python SQL_DB_Connect_workspace.py --config d1000_queue.json
 """
 
 ###############################################################################
 # Load libraries and modules #
 ###############################################################################
+import argparse
 import datetime
 import os
 import re
 import random
+import sys
 import tkinter
 import tkinter.filedialog
-import sqlalchemy
-import pyodbc
 import pandas as pd
+from batch_queue import file_date, read_queue, run_queue
+from excel_readers import open_workbook
+from sql_connection import configure, get_engine
+from sql_schema import typed_frame
+from sql_upload import append_master, upload_frame
+
+
+# Engine used to read xlsx files, see excel_readers.py. None picks the
+# fastest one installed
+EXCEL_ENGINE = None
+
+# Raw sheets are cached here as Parquet, keyed by workbook content and sheet,
+# so reruns on the same workbook skip Excel parsing. Entries unused for
+# EXCEL_CACHE_DAYS, and the oldest beyond EXCEL_CACHE_MB, are evicted. None
+# turns the cache off
+EXCEL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.excel_cache')
+EXCEL_CACHE_DAYS = 30
+EXCEL_CACHE_MB = 2048
+
+# How frames are inserted into the SQL database, see sql_upload.py. None
+# picks the strategy for the database and the default batch size. The copy
+# strategy stages its files in UPLOAD_STAGE_DIR, which SQL Server must be
+# able to read
+UPLOAD_STRATEGY = None
+UPLOAD_BATCH_SIZE = None
+UPLOAD_STAGE_DIR = None
+
+# Column types of every uploaded sheet, kept as JSON files here so that each
+# monthly table gets the same compact types (see sql_schema.py)
+SQL_TYPES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'sql_types')
+
+# Every upload is also added to its master table, replacing rows an earlier
+# load of the same sourcefile date left there (see sql_upload.append_master)
+APPEND_TO_MASTER = True
+D1000_MASTER = 'df_DB1000_MASTER_DELETEME'
+
+# Options of an unattended load and their defaults. A config file or a queue
+# entry may set any of these, and every entry must set confirm
+BATCH_DEFAULTS = {'sheet': 'Milestones', 'out_dir': '.', 'confirm': False}
 
 
 ###############################################################################
@@ -54,19 +102,13 @@ import pandas as pd
 
 def connect_sql():
     """
-    SQL server details. Returns connection to the server
+    Returns connection to the server, taken from the shared connection pool;
+    closing it hands it back. The server is configured in sql_connection.py
 
     Because we have defined our server as DSN, we use "trusted source"
     credentialing, but there are other ways to do this, if necessary.
     """
-
-    # Define SQL server details
-    SERVER = 'SFSVMSQL3'
-    DATABASE = 'PGE_SIP'
-    DSN = 'PGE_SIP'
-
-    # Connect to servers
-    return pyodbc.connect('DSN='+DSN+';SERVER='+SERVER+';DATABASE='+DATABASE+';')
+    return get_engine().connect()
 
 
 def example():
@@ -90,65 +132,72 @@ def example():
     conn.close()
 
 
-def get_D1000_file():
+def get_D1000_file(path=None, sheet=None):
     """
     Opens up a dialog box to ask the user to select the appropriate D1000 file
     Afterwards, function prompts the user to select the relevant sheet,
     e.g. Milestone, which is likely to be the default sheet to be imported.
 
-    Note: User input is required
+    Note: User input is required, unless the path and sheet are given
     """
-    root = tkinter.Tk()
+    if path is None:
+        root = tkinter.Tk()
 
-    # Ask the user to select the appropriate D1000 file
-    print("Please choose the D1000 source file that you'd like to import")
-    DB1000_sourcefile = tkinter.filedialog.askopenfile(parent=root, mode='rb',
-                                                       title="")
-    root.destroy()
+        # Ask the user to select the appropriate D1000 file
+        print("Please choose the D1000 source file that you'd like to import")
+        DB1000_sourcefile = tkinter.filedialog.askopenfile(parent=root,
+                                                           mode='rb', title="")
+        root.destroy()
+        path = DB1000_sourcefile.name
+
+        # Close the source file, it is read again from its path
+        DB1000_sourcefile.close()
 
     print("\nRegistering D1000 file. May take a few minutes...\n")
 
-    # Convert to a panda dataframe
-    XL_DB1000 = pd.ExcelFile(DB1000_sourcefile)
+    # Open the workbook once; the chosen sheet is parsed from it below
+    XL_DB1000 = open_workbook(path, EXCEL_ENGINE,
+                              EXCEL_CACHE_DIR, EXCEL_CACHE_DAYS, EXCEL_CACHE_MB)
     DB1000_sheetnames = list(XL_DB1000.sheet_names)
     print("Available sheets {}".format(DB1000_sheetnames))
 
-    # 'Milestones' is used as default, unless user specifies otherwise
-    response = input("Would you like to import data from 'Milestones'?\n"
-                     "(1 = confirm, 0 = reject) ")
-
-    DB1000_sheet = ''
-    if response == '1':
-        DB1000_sheet = "Milestones"
-        print("\nGreat! Importing data from 'Milestones'...\n")
+    if sheet is not None:
+        if sheet not in DB1000_sheetnames:
+            raise ValueError("Sheet '{}' does not exist in {}".format(sheet,
+                                                                       path))
+        DB1000_sheet = sheet
+        print("\nImporting data from '{}'...\n".format(DB1000_sheet))
     else:
-        while DB1000_sheet not in DB1000_sheetnames:
-            DB1000_sheet = input("Please enter the desired sheet name exactly "
-                                 "as it appears above, minus the quotes: ")
-            if DB1000_sheet in DB1000_sheetnames:
-                print("\nNote that this program is currently configured to "
-                      "only modify the 'Milestones' worksheet.  It may or "
-                      "may not work with other sheets, depending on the "
-                      "similarity of structure with the 'Milestones' sheet. "
-                      "Please check the output to file ensure it meets your "
-                      "needs or let the developer now!"
-                      "\n\nFor now Importing from {}...".format(DB1000_sheet))
-            else:
-                print("\nError! Sheet does not exist. Double check and "
-                      "enter the correct sheet name again.")
+        # 'Milestones' is used as default, unless user specifies otherwise
+        response = input("Would you like to import data from 'Milestones'?\n"
+                         "(1 = confirm, 0 = reject) ")
+
+        DB1000_sheet = ''
+        if response == '1':
+            DB1000_sheet = "Milestones"
+            print("\nGreat! Importing data from 'Milestones'...\n")
+        else:
+            while DB1000_sheet not in DB1000_sheetnames:
+                DB1000_sheet = input("Please enter the desired sheet name "
+                                     "exactly as it appears above, minus the "
+                                     "quotes: ")
+                if DB1000_sheet in DB1000_sheetnames:
+                    print("\nNote that this program is currently configured "
+                          "to only modify the 'Milestones' worksheet.  It may "
+                          "or may not work with other sheets, depending on the "
+                          "similarity of structure with the 'Milestones' "
+                          "sheet. Please check the output to file ensure it "
+                          "meets your needs or let the developer now!"
+                          "\n\nFor now Importing from {}...".format(
+                              DB1000_sheet))
+                else:
+                    print("\nError! Sheet does not exist. Double check and "
+                          "enter the correct sheet name again.")
 
     # Load file into a pandas frame for the DB1000 sheet provided by user
-    df = pd.read_excel(io=DB1000_sourcefile, sheet_name=DB1000_sheet)
-
-    # Get date of the data file assuming that date is always in MMDDYYYY
-    # format at the end of the file name
-    dbdate_s = re.sub('.xlsx'r'\'>|.xls'r'\'>', '', str(DB1000_sourcefile))
-    dbdate_s = dbdate_s[len(dbdate_s)-8: len(dbdate_s)]
+    df = XL_DB1000.parse(sheet_name=DB1000_sheet)
 
-    # Close the source file
-    DB1000_sourcefile.close()
-
-    return(df, dbdate_s)
+    return(df, file_date(path))
 
 
 def rename_cols(col_list, var):
@@ -183,17 +232,20 @@ def rename_cols(col_list, var):
     return(milestone_names, milestone_list, has_fewer_than_4_alphachar)
 
 
-def autoname_check(milestone_list):
+def autoname_check(milestone_list, confirm=False):
     """
     Confirm with user that the column names make sense.
 
     Essentially, a failsafe to have the user confirm the result from a random
-    set of  potentially identified milestone names!
+    set of  potentially identified milestone names! With confirm, the sample
+    is only printed and the names are accepted without asking
     """
     # create a list of random milestone names from the milestone_list
-    rand = random.sample(range(len(milestone_list)), 5)
-    randlist = [milestone_list[rand[0]], milestone_list[rand[1]],
-                milestone_list[rand[2]], milestone_list[rand[3]]]
+    randlist = random.sample(milestone_list, min(4, len(milestone_list)))
+    if confirm:
+        print("Accepting milestone names, e.g. %s" % randlist)
+        return 1
+
     user_input = int(input("Do these look like actual milestones "
                            "(yes = 1, no = 0)?\n %s" % randlist))
 
@@ -247,24 +299,30 @@ def del_blank_cols(df):
     return df.drop(df.columns[blank_cols], axis=1)
 
 
-def save_db(df, dbdate):
+def save_db(df, dbdate, out_dir=None):
     """
     Saves output file(s) on local drive to QA/QC, verify code works and if
     the SQL db already contains the db. In this case, instead of appending
     a duplicate copy, copy is stored on local drive.
+
+    The user is asked for the folder unless out_dir is given
     """
     name_of_db = 'df_DB1000_' + dbdate + '.csv'
-    root = tkinter.Tk()
 
-    print("Please choose the folder to store the output file in\n")
-    os.chdir(tkinter.filedialog.askdirectory(parent=root))
-    root.destroy()
+    if out_dir is None:
+        root = tkinter.Tk()
+
+        print("Please choose the folder to store the output file in\n")
+        out_dir = tkinter.filedialog.askdirectory(parent=root)
+        root.destroy()
+    os.makedirs(out_dir, exist_ok=True)
 
-    print("Output file {} being stored in {}".format(name_of_db, os.getcwd()))
-    df.to_csv(name_of_db, index=False)
+    print("Output file {} being stored in {}".format(name_of_db,
+                                                     os.path.abspath(out_dir)))
+    df.to_csv(os.path.join(out_dir, name_of_db), index=False)
 
 
-def upload_sched(df, dbdate):
+def upload_sched(df, dbdate, out_dir=None):
     """
     Upload cleaned "Schedule" source file (from pandas dataframe) to database
 
@@ -272,80 +330,168 @@ def upload_sched(df, dbdate):
     "sqlalchemy" is used here to bridge the gap.
 
     The code first uploads the database as an stand-alone data table to SQL;
-    and then appends it to the master table.
+    and then appends it to the master table, D1000_MASTER, replacing any
+    rows already there for this sourcefile date. Columns are stored with the
+    compact types kept for the D1000 in SQL_TYPES_DIR (see sql_schema.py)
+    rather than FLOAT and NVARCHAR(max).
 
-    The upload currently takes upwords of 4 minutes, but can be made faster
-    with some tweaking or use of "turbodc" package
+    Rows are inserted in bulk with UPLOAD_STRATEGY (see sql_upload.py)
+    rather than one round trip per row, which took upwards of 4 minutes. If
+    the upload fails, the frame is saved to out_dir instead (see save_db).
+
+    Returns the error that stopped the upload, or None
     """
 
     # Time this process -- takes ~ 200 - 400 seconds
     start = datetime.datetime.now()
 
-    # Create MSSQL engine using Windows authentication and DSN as defined above
-    # This will serve as our connection for "df.to_sql"
+    # The shared, pooled engine (see sql_connection.py) will serve as our
+    # connection for the upload
+    error = None
     try:
         print("\n\nUploading to SQL server. Please wait...\n")
 
-        DSN = 'PGE_SIP'
-        mssql_engine = sqlalchemy.create_engine('mssql+pyodbc://'+DSN)
+        mssql_engine = get_engine()
 
         # desired database parameters
         name_of_db_in_SQL = 'df_DB1000_' + dbdate + '_DELETEME'
 
-        # Upload dataframe as stand-alone table to the SQL db
-        # Note: Can probably be made faster with turbodbc" package
-        df.to_sql(name=name_of_db_in_SQL, con=mssql_engine,
-                  if_exists='replace', chunksize=10**3)
+        # Explicit SQL type of every column, and the values converted to it
+        typed, dtype = typed_frame(df, 'D1000', SQL_TYPES_DIR)
 
-    except:
+        # Upload dataframe as stand-alone table to the SQL db
+        upload_frame(typed, name_of_db_in_SQL, mssql_engine,
+                     if_exists='replace', dtype=dtype,
+                     strategy=UPLOAD_STRATEGY, batch_size=UPLOAD_BATCH_SIZE,
+                     stage_dir=UPLOAD_STAGE_DIR)
+
+        # Add this month's data to the master table, without duplicating a
+        # sourcefile date that was loaded before
+        if APPEND_TO_MASTER:
+            status = append_master(typed, D1000_MASTER, mssql_engine,
+                                   dtype=dtype, strategy=UPLOAD_STRATEGY,
+                                   batch_size=UPLOAD_BATCH_SIZE,
+                                   stage_dir=UPLOAD_STAGE_DIR)
+            print("Master table {}: {} rows of {}".format(D1000_MASTER,
+                                                          status, dbdate))
+
+    except Exception as e:
+        error = e
         print("\n\n*************************************\n"
               "Could not connect/write to SQL server. \n"
               "Do you have read/write access to the SQL server?\n"
               "Saving to local machine for now..."
               "\n\n*************************************\n")
-        save_db(df, dbdate)
+        save_db(df, dbdate, out_dir)
 
     # print out how long the process took
     end = datetime.datetime.now()
     print("Process length: ", str(end - start))
 
+    return error
+
+
+def clean_D1000(df_DB1000, db_date, confirm=False):
+    """
+    Names the milestone columns of a D1000 sheet, adds the sourcefile date and
+    drops blank columns. The user confirms the milestone names unless confirm
+    is set. Raises a ValueError if neither the Forecast nor the Actual
+    columns hold the milestone names, or if the user rejects them
     """
-    THE WHOLE THING NEEDS TO BE FIXED!!!!!!!!!!!!
-    # Add current month to master list, while being wary of duplication
+    # Produce column name list from the D1000 sheet
+    col_list_DB1000 = list(df_DB1000.columns)
+
+    # Auto rename columns
+    forecast_milestone_names, milestone_list_f, has_fewer_than_4_alphachar_f = \
+        rename_cols(col_list_DB1000, "forecast")
+    act_milestone_names, milestone_list_a, has_fewer_than_4_alphachar_a = \
+        rename_cols(col_list_DB1000, "act.")
+
+    # Confirm which variable has column names
+    milestone_name_bucket = '**error, fix this block of code**'
+    fyes = 0
+    ayes = 0
+
+    if (len(forecast_milestone_names) > 0) and (has_fewer_than_4_alphachar_f == []):
+        fyes = 1
+        milestone_name_bucket = 'Forecast'
+        print("This month's naming column is Forecast")
+    if (len(act_milestone_names) > 0) and (has_fewer_than_4_alphachar_a == []):
+        ayes = 1
+        milestone_name_bucket = "Act."
+        print("This month's naming column is Actual")
+    if fyes == 0 and ayes == 0:
+        raise ValueError("Algorithm could not determine which column includes "
+                         "milestone name")
+    if fyes == 1 and ayes == 1:
+        print("Something is amiss in the data. Both Forecast and Actual met "
+              "the milestone name inclusion test criteria.")
+
+    # Confirm with user that the column names make sense
+    if fyes:
+        user_milestone_input = autoname_check(milestone_list_f, confirm)
+    if ayes:
+        user_milestone_input = autoname_check(milestone_list_a, confirm)
+
+    if not user_milestone_input:
+        print("\n\n********************************************************\n"
+              "Uh oh. The Python code for naming milestone columns may need "
+              "some work!\nContact your programmer support folks."
+              "\n\n********************************************************\n")
+        raise ValueError("The {} milestone names were rejected".format(
+            milestone_name_bucket))
 
-    # CHECK into column order during master append.
-    # Does this month's column order match or allign with the master?
-    # If a new column needs to be added, will it do so automatically?
+    # the winner is!
+    print("\nThe %s columns hold the milestone name." % milestone_name_bucket)
 
-    # reconnect to server
-    conn = connect_sql()
+    # Create a set of all unique milestones for posterity
+    if fyes:
+        unique_milestones = set(milestone_list_f)
+    if ayes:
+        unique_milestones = set(milestone_list_a)
 
-    # read the full set of sourcefile dates that have already been entered
-    ao_master_sourcefiledate_excerpt = pd.read_sql('Select sourcefile_date from dbo.df_DB1000_MASTER_DELETEME', conn)
-    conn.close()
 
-    # ### Appending data to master datatable
-    # only if this months sourcefile date does not already exist
-    # ASSUMPTION: only one sourcefile per sourcefile date
-    if dbdate not in list(set(ao_master_sourcefiledate_excerpt.iloc[:, 0])):
-        # Time this process -- takes ~ 200 - 400 seconds
-        start = datetime.datetime.now()
-
-        # ## Append this month's data to master database
-        name_of_masterdb_in_SQL = 'df_DB1000_MASTER_DELETEME'
-        # ## This can be made much faster with some tweaking
-        df.to_sql(name=name_of_masterdb_in_SQL,
-                  con=mssql_engine,
-                  # change to 'replace' if starting from scratch
-                  if_exists='append')
-        end = datetime.datetime.now()
-        print(end - start)
-    else:
-        print("NOTE: It looks like " + name_of_db_in_SQL + " has already been "
-              "appended to its master.\n"
-              "A copy of the file will be stored locally for your review.")
-        save_db(df, dbdate)
+    # Loop through every column name and apply Milestone names where appropriate
+
+    # If Forecast is named column
+    if fyes:
+        df_DB1000.columns = apply_milestone_names("Forecast",
+                                                  forecast_milestone_names,
+                                                  milestone_list_f,
+                                                  col_list_DB1000)
+
+    # If actual is named column
+    if ayes:
+        df_DB1000.columns = apply_milestone_names("Actual",
+                                                  act_milestone_names,
+                                                  milestone_list_a,
+                                                  col_list_DB1000)
+
+    # Add Date column
+    # ASSUMPTION: date AlWAYS included in MMDDYYYY format at end of file name
+    df_DB1000['sourcefile_date'] = db_date
+
+    # Delete blank columns
+    df_DB1000 = del_blank_cols(df_DB1000)
+
+    return df_DB1000
+
+
+def load_D1000(path=None, sheet=None, out_dir=None, confirm=False):
+    """
+    Imports one D1000 file, cleans it and uploads it to the SQL database.
+    Anything not given is asked for. Raises a RuntimeError if the upload
+    fails, after the frame is saved locally (see upload_sched)
     """
+    df_DB1000, db_date = get_D1000_file(path, sheet)
+    df_DB1000 = clean_D1000(df_DB1000, db_date, confirm)
+
+    # Upload cleaned "Schedule" source file to SQL database
+    error = upload_sched(df_DB1000, db_date, out_dir)
+    if error is not None:
+        raise RuntimeError("Upload of D1000 {} failed, saved locally instead: "
+                           "{}: {}".format(db_date, error.__class__.__name__,
+                                           error)) from error
 
 
 ###############################################################################
@@ -371,81 +517,54 @@ def upload_sched(df, dbdate):
 # Example of what we are trying to achieve
 # example()
 
-# Produce column name list from the D1000 sheet imported above
-df_DB1000, db_date = get_D1000_file()
-col_list_DB1000 = list(df_DB1000.columns)
-
-# Auto rename columns
-forecast_milestone_names, milestone_list_f, has_fewer_than_4_alphachar_f = rename_cols(col_list_DB1000, "forecast")
-act_milestone_names, milestone_list_a, has_fewer_than_4_alphachar_a = rename_cols(col_list_DB1000, "act.")
-
-# Confirm which variable has column names
-milestone_name_bucket = '**error, fix this block of code**'
-fyes = 0
-ayes = 0
-
-if (len(forecast_milestone_names) > 0) and (has_fewer_than_4_alphachar_f == []):
-    fyes = 1
-    milestone_name_bucket = 'Forecast'
-    print("This month's naming column is Forecast")
-if (len(act_milestone_names) > 0) and (has_fewer_than_4_alphachar_a == []):
-    ayes = 1
-    milestone_name_bucket = "Act."
-    print("This month's naming column is Actual")
-if fyes == 0 and ayes == 0:
-    print("Error. Algorithm could not determine which column includes "
-          "milestone name")
-if fyes == 1 and ayes == 1:
-    print("Something is amiss in the data. Both Forecast and Actual met the "
-          "milestone name inclusion test criteria.")
-
-# Confirm with user that the column names make sense
-if fyes:
-    user_milestone_input = autoname_check(milestone_list_f)
-if ayes:
-    user_milestone_input = autoname_check(milestone_list_a)
-
-if user_milestone_input:
-    # the winner is!
-    print("\nThe %s columns hold the milestone name." % milestone_name_bucket)
-else:
-    milestone_name_bucket = 'error'
-    print("\n\n********************************************************\n"
-          "Uh oh. The Python code for naming milestone columns may need "
-          "some work!\nContact your programmer support folks."
-          "\n\n********************************************************\n")
-
-# Create a set of all unique milestones for posterity
-if fyes:
-    unique_milestones = set(milestone_list_f)
-if ayes:
-    unique_milestones = set(milestone_list_a)
-
-
-# Loop through every column name and apply Milestone names where appropriate
-
-# If Forecast is named column
-if fyes:
-    df_DB1000.columns = apply_milestone_names("Forecast",
-                                              forecast_milestone_names,
-                                              milestone_list_f,
-                                              col_list_DB1000)
-
-# If actual is named column
-if ayes:
-    df_DB1000.columns = apply_milestone_names("Actual",
-                                              act_milestone_names,
-                                              milestone_list_a,
-                                              col_list_DB1000)
-
-# Add Date column
-# ASSUMPTION: date AlWAYS included in MMDDYYYY format at end of file name
-df_DB1000['sourcefile_date'] = db_date
-
-# Delete blank columns
-df_DB1000 = del_blank_cols(df_DB1000)
-
-# Upload cleaned "Schedule" source file to SQL database
-upload_sched(df_DB1000, db_date)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='clean D1000 files and upload them to the PGE_SIP database')
+    parser.add_argument('files', nargs='*',
+                        help='D1000 files or glob patterns to load one after '
+                        'the other without asking anything; needs '
+                        '--confirm-milestones or "confirm" in the config. '
+                        'Without files or --config, the file, sheet and folder '
+                        'are asked for')
+    parser.add_argument('--config', default=None,
+                        help='JSON file with a "files" list and any of '
+                        '"sheet", "out_dir" and "confirm" for all of them')
+    parser.add_argument('--sheet', default=None,
+                        help='sheet to import (default: Milestones)')
+    parser.add_argument('--out-dir', default=None,
+                        help='folder to store local copies in when the upload '
+                        'fails (default: the current folder)')
+    parser.add_argument('--confirm-milestones', dest='confirm',
+                        action='store_true', default=None,
+                        help='accept the detected milestone names without '
+                        'asking, required to load files unattended')
+    parser.add_argument('--db-url', default=None,
+                        help='SQLAlchemy URL of the database (default: the '
+                        'PGE_SIP DSN, see sql_connection.py)')
+    parser.add_argument('--db-config', default=None,
+                        help='JSON file with the database "url" and engine '
+                        'options')
+    args = parser.parse_args()
+    configure(args.db_url, args.db_config)
+
+    if args.files or args.config:
+        queue = read_queue(BATCH_DEFAULTS, args.config, args.files,
+                           sheet=args.sheet, out_dir=args.out_dir,
+                           confirm=args.confirm)
+        unconfirmed = [path for path, options in queue
+                       if not options['confirm']]
+        if unconfirmed:
+            parser.error('milestone names of {} would be asked for; pass '
+                         '--confirm-milestones or set "confirm" in the '
+                         'config'.format(unconfirmed))
+        failed = run_queue(queue, load_D1000)
+        print("\n{} of {} files loaded".format(len(queue) - len(failed),
+                                               len(queue)))
+        if failed:
+            print("Failed: {}".format(failed))
+            sys.exit(1)
+    else:
+        # Ask for the file, sheet and output folder
+        load_D1000()
 
 # ########################################################################### #
@@ -0,0 +1,87 @@
+"""
+# coding: utf-8
+
+# # Unattended loading of AO and D1000 files
+#
+# Both loaders take a list of files, or a JSON config file, and load them one
+# after the other without asking anything. read_queue() expands the config
+# and glob patterns into (path, options) pairs, checked against the loader's
+# batch options and their defaults, and run_queue() hands each pair to the
+# loader's load function, carrying on past files that fail. A config file
+# looks like:
+#     {"out_dir": "ao_csv", "upload": true,
+#      "files": ["AO_*2020.xlsx", {"path": "AO_01312021.xlsx", "workers": 2}]}
+"""
+
+###############################################################################
+# Load libraries and modules #
+###############################################################################
+import glob
+import json
+import os
+
+
+###############################################################################
+# Functions #
+###############################################################################
+
+def file_date(path):
+    """
+    Date of a data file, assuming that date is always in MMDDYYYY format at
+    the end of the file name
+    """
+    return os.path.splitext(os.path.basename(path))[0][-8:]
+
+
+def read_queue(defaults, config_file=None, paths=(), **options):
+    """
+    Queue of files to load unattended, as (path, options) pairs.
+
+    defaults holds every batch option of the loader and its default. The
+    JSON config file holds a "files" list and any of these options for all of
+    them. A file is a path or glob pattern, or a dictionary with a "path" and
+    options for that file only. paths are added after the config files;
+    options that are not None override the config
+    """
+    config = {}
+    if config_file is not None:
+        with open(config_file) as f:
+            config = json.load(f)
+
+    settings = dict(defaults)
+    settings.update({key: value for key, value in config.items()
+                     if key != 'files'})
+    settings.update({key: value for key, value in options.items()
+                     if value is not None})
+
+    queue = []
+    for entry in list(config.get('files', [])) + list(paths):
+        if isinstance(entry, str):
+            entry = {'path': entry}
+        entry = dict(entry)
+        pattern = entry.pop('path')
+        unknown = (set(entry) | set(settings)) - set(defaults)
+        if unknown:
+            raise ValueError("Unknown batch options {} for {}".format(
+                sorted(unknown), pattern))
+
+        # A pattern matching nothing is kept so that its load fails loudly
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            queue.append((path, dict(settings, **entry)))
+    return queue
+
+
+def run_queue(queue, load):
+    """
+    Loads every file in the queue in turn with load(path, **options),
+    carrying on past files that fail. Returns the paths that failed
+    """
+    failed = []
+    for number, (path, options) in enumerate(queue, 1):
+        print("\n[{}/{}] Loading {}".format(number, len(queue), path))
+        try:
+            load(path, **options)
+        except Exception as e:
+            print("Could not load {}: {}".format(path, e))
+            failed.append(path)
+    return failed
@@ -0,0 +1,478 @@
+"""
+# coding: utf-8
+
+# # Pluggable xlsx readers for the AO and D1000 imports
+#
+# pd.ExcelFile with the default engine builds a Python cell object for every
+# cell in the workbook, which is why registering an AO or D1000 file takes
+# minutes. The readers here return the same dataframes as
+# pd.ExcelFile.parse, from one of these engines:
+#
+#     - 'pandas': pd.ExcelFile with its default engine (the old behaviour)
+#     - 'stream': openpyxl in read-only mode, reading plain values row by row
+#       without building cell objects
+#     - 'calamine': the Rust calamine parser, if python-calamine is installed
+#
+# open_workbook() picks the fastest installed engine unless one is named.
+#
+# With a cache_dir, every parsed sheet is also stored there as Parquet, keyed
+# by the workbook's content hash, the sheet name and the header row. Reruns on
+# the same workbook then load the raw frames without opening the workbook.
+# Entries unused for cache_days, and the least recently used ones beyond
+# cache_mb, are evicted.
+#
+# Running this file benchmarks the engines on a workbook:
+#     python excel_readers.py AO_file_01312020.xlsx --repeat 3
+"""
+
+###############################################################################
+# Load libraries and modules #
+###############################################################################
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import time
+import pandas as pd
+import numpy as np
+from pandas.io.parsers import TextParser
+
+
+###############################################################################
+# Functions #
+###############################################################################
+
+# Values openpyxl gives error cells when it only returns plain values
+EXCEL_ERRORS = {'#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!',
+                '#N/A'}
+
+
+def convert_value(value):
+    """
+    Converts a cell value the way pandas' Excel readers do: empty cells
+    become '', error cells NaN and whole floats ints
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        if value.is_integer():
+            return int(value)
+    elif isinstance(value, str):
+        if value in EXCEL_ERRORS:
+            return np.nan
+    elif isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    return value
+
+
+def trim_rows(rows):
+    """
+    Drops trailing empty cells and rows and pads every row to the same
+    width, as pandas does before parsing a sheet
+    """
+    data = []
+    last_row_with_data = -1
+    for row_number, row in enumerate(rows):
+        row = [convert_value(value) for value in row]
+        while row and row[-1] == '':
+            row.pop()
+        if row:
+            last_row_with_data = row_number
+        data.append(row)
+    data = data[:last_row_with_data + 1]
+
+    if data:
+        width = max(len(row) for row in data)
+        data = [row + [''] * (width - len(row)) for row in data]
+    return data
+
+
+def frame_from_rows(data, header=0):
+    """
+    Turns the rows of a sheet into a dataframe with pandas' own Excel
+    parsing rules, so column names and dtypes match pd.read_excel
+    """
+    if not data:
+        return pd.DataFrame()
+    return TextParser(data, header=header).read()
+
+
+class PandasWorkbook:
+    """
+    pd.ExcelFile with its default engine
+    """
+
+    def __init__(self, path):
+        self.book = pd.ExcelFile(path)
+        self.sheet_names = list(self.book.sheet_names)
+
+    def parse(self, sheet_name=0, header=0):
+        return self.book.parse(sheet_name=sheet_name, header=header)
+
+
+class StreamWorkbook:
+    """
+    openpyxl in read-only mode, reading plain values instead of cells
+    """
+
+    def __init__(self, path):
+        import openpyxl
+
+        self.book = openpyxl.load_workbook(path, read_only=True,
+                                           data_only=True, keep_links=False)
+        self.sheet_names = list(self.book.sheetnames)
+
+    def parse(self, sheet_name=0, header=0):
+        if isinstance(sheet_name, int):
+            sheet_name = self.sheet_names[sheet_name]
+        sheet = self.book[sheet_name]
+        sheet.reset_dimensions()
+        return frame_from_rows(trim_rows(sheet.iter_rows(values_only=True)),
+                               header)
+
+
+class CalamineWorkbook:
+    """
+    The calamine parser from the python-calamine package
+    """
+
+    def __init__(self, path):
+        import python_calamine
+
+        self.book = python_calamine.CalamineWorkbook.from_path(path)
+        self.sheet_names = list(self.book.sheet_names)
+
+    def parse(self, sheet_name=0, header=0):
+        if isinstance(sheet_name, int):
+            sheet = self.book.get_sheet_by_index(sheet_name)
+        else:
+            sheet = self.book.get_sheet_by_name(sheet_name)
+        rows = sheet.to_python(skip_empty_area=False)
+        return frame_from_rows(trim_rows(rows), header)
+
+
+# Fastest first
+ENGINES = {
+    'calamine': CalamineWorkbook,
+    'stream': StreamWorkbook,
+    'pandas': PandasWorkbook,
+}
+
+
+def available_engines():
+    """
+    Names of the engines whose packages are installed, fastest first
+    """
+    available = []
+    for name, module in [('calamine', 'python_calamine'),
+                         ('stream', 'openpyxl'), ('pandas', 'openpyxl')]:
+        try:
+            __import__(module)
+            available.append(name)
+        except ImportError:
+            pass
+    return available
+
+
+def open_workbook(path, engine=None, cache_dir=None, cache_days=30,
+                  cache_mb=2048):
+    """
+    Opens an xlsx workbook. The returned workbook has the sheet_names and
+    parse(sheet_name, header) of pd.ExcelFile.
+
+    engine is one of ENGINES; None picks the fastest installed one. With a
+    cache_dir, parsed sheets are cached there (see CachedWorkbook)
+    """
+    if cache_dir is not None:
+        return CachedWorkbook(path, engine, cache_dir, cache_days, cache_mb)
+    if engine is None:
+        engine = (available_engines() or ['pandas'])[0]
+    if engine not in ENGINES:
+        raise ValueError("Unknown Excel engine '{}'. Choose from {}".format(
+            engine, list(ENGINES)))
+    return ENGINES[engine](path)
+
+
+# Bump when the cached frame layout changes
+CACHE_VERSION = 1
+
+
+def file_hash(path):
+    """
+    Hash of the file content
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def encode_value(value):
+    """
+    Type code and text of a cell value, from which decode_value rebuilds it
+    exactly
+    """
+    if value is None:
+        return 'z', ''
+    if isinstance(value, str):
+        return 's', value
+    if isinstance(value, (bool, np.bool_)):
+        return 'b', str(int(value))
+    if isinstance(value, (int, np.integer)):
+        return 'i', str(value)
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return 'n', ''
+        return 'f', repr(float(value))
+    if isinstance(value, datetime.datetime):
+        return 'd', pd.Timestamp(value).isoformat()
+    if isinstance(value, datetime.time):
+        return 't', value.isoformat()
+    raise TypeError("Cannot cache a cell of type {}".format(type(value)))
+
+
+DECODERS = {
+    'z': lambda text: None,
+    's': str,
+    'b': lambda text: bool(int(text)),
+    'i': int,
+    'n': lambda text: np.nan,
+    'f': float,
+    'd': pd.Timestamp,
+    't': datetime.time.fromisoformat,
+}
+
+
+def decode_value(code, text):
+    return DECODERS[code](text)
+
+
+def is_plain(col):
+    """
+    True if Parquet can store the column as it is. Object columns can only
+    hold text and NaN; columns mixing text, numbers and dates are encoded
+    """
+    if col.dtype != object:
+        return True
+    return all(isinstance(value, str) for value in col.dropna())
+
+
+def write_cached_frame(df, file):
+    """
+    Stores a parsed sheet as Parquet. Columns are stored by position, and the
+    original column names and mixed-type columns are encoded in the file
+    metadata and in text/type column pairs
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0:
+        raise ValueError("Only sheets with a default index are cached")
+
+    stored = {}
+    encoded = []
+    for i, (_, col) in enumerate(df.items()):
+        if is_plain(col):
+            stored['c{}'.format(i)] = col.to_numpy()
+        else:
+            codes, texts = zip(*map(encode_value, col)) if len(col) else ((), ())
+            stored['c{}'.format(i)] = np.array(texts, dtype=object)
+            stored['c{}_type'.format(i)] = np.array(codes, dtype=object)
+            encoded.append(i)
+
+    meta = {'columns': [encode_value(name) for name in df.columns],
+            'encoded': encoded, 'version': CACHE_VERSION}
+    table = pyarrow.Table.from_pandas(pd.DataFrame(stored, index=df.index),
+                                      preserve_index=False)
+    table = table.replace_schema_metadata(dict(
+        table.schema.metadata, excel_cache=json.dumps(meta)))
+
+    # Write to a temporary file first so a reader never sees half a file
+    tmp = '{0}.{1}.tmp'.format(file, os.getpid())
+    try:
+        pyarrow.parquet.write_table(table, tmp)
+        os.replace(tmp, file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_cached_frame(file):
+    """
+    Loads a sheet stored by write_cached_frame
+    """
+    import pyarrow.parquet
+
+    table = pyarrow.parquet.read_table(file)
+    meta = json.loads(table.schema.metadata[b'excel_cache'])
+    stored = table.to_pandas()
+
+    df = pd.DataFrame(index=stored.index)
+    for i in range(len(meta['columns'])):
+        name = 'c{}'.format(i)
+        if i in meta['encoded']:
+            df[i] = [decode_value(code, text) for code, text
+                     in zip(stored[name + '_type'], stored[name])]
+            df[i] = df[i].astype(object)
+        else:
+            df[i] = stored[name]
+    df.columns = [decode_value(code, text) for code, text in meta['columns']]
+    return df
+
+
+def evict_cache(cache_dir, max_days, max_bytes):
+    """
+    Deletes cache files unused for more than max_days, then the least
+    recently used ones until the cache fits in max_bytes
+    """
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*.*')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    oldest = time.time() - max_days * 24 * 3600
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in sorted(entries):
+        if mtime >= oldest and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class CachedWorkbook:
+    """
+    Workbook whose sheet names and parsed sheets are cached as files in
+    cache_dir. The workbook itself is only opened when something is not in
+    the cache yet. Caching is best effort: if a sheet cannot be stored, e.g.
+    because pyarrow is not installed, it is just parsed every time
+    """
+
+    def __init__(self, path, engine=None, cache_dir='.excel_cache',
+                 cache_days=30, cache_mb=2048):
+        self.path = path
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self.cache_days = cache_days
+        self.cache_bytes = cache_mb * 2**20
+        self.key = '{0}_v{1}'.format(file_hash(path), CACHE_VERSION)
+        self._book = None
+
+        names_file = os.path.join(cache_dir, self.key + '_sheets.json')
+        try:
+            with open(names_file) as f:
+                self.sheet_names = json.load(f)
+            os.utime(names_file)
+        except (FileNotFoundError, ValueError):
+            self.sheet_names = list(self.book.sheet_names)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(names_file, 'w') as f:
+                    json.dump(self.sheet_names, f)
+            except OSError as e:
+                print("Could not cache sheet names of {}: {}".format(path, e))
+
+    @property
+    def book(self):
+        if self._book is None:
+            self._book = open_workbook(self.path, self.engine)
+        return self._book
+
+    def sheet_file(self, sheet_name, header):
+        sheet_key = hashlib.blake2b(sheet_name.encode('utf-8'),
+                                    digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, '{0}_{1}_{2}.parquet'.format(
+            self.key, sheet_key, header))
+
+    def parse(self, sheet_name=0, header=0):
+        if isinstance(sheet_name, int):
+            sheet_name = self.sheet_names[sheet_name]
+        file = self.sheet_file(sheet_name, header)
+        try:
+            df = read_cached_frame(file)
+            # Mark as recently used for eviction
+            os.utime(file)
+            return df
+        except (FileNotFoundError, ImportError):
+            pass
+
+        df = self.book.parse(sheet_name, header)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_cached_frame(df, file)
+            evict_cache(self.cache_dir, self.cache_days, self.cache_bytes)
+        except Exception as e:
+            print("Could not cache sheet {}: {}".format(sheet_name, e))
+        return df
+
+
+def benchmark(path, sheets=None, repeat=3, header=None):
+    """
+    Times opening the workbook and parsing each sheet with every installed
+    engine and checks each frame against the pandas engine. Returns a
+    dataframe with one row per engine and sheet
+    """
+    reference = open_workbook(path, 'pandas')
+    sheets = sheets or reference.sheet_names
+    expected = {sheet: reference.parse(sheet, header) for sheet in sheets}
+
+    results = []
+    for engine in available_engines():
+        best = {}
+        for _ in range(repeat):
+            start = time.perf_counter()
+            book = open_workbook(path, engine)
+            best['open'] = min(best.get('open', np.inf),
+                               time.perf_counter() - start)
+            for sheet in sheets:
+                start = time.perf_counter()
+                df = book.parse(sheet, header)
+                best[sheet] = min(best.get(sheet, np.inf),
+                                  time.perf_counter() - start)
+
+        for sheet, seconds in best.items():
+            same = ''
+            if sheet in expected:
+                same = df_equal(book.parse(sheet, header), expected[sheet])
+            results.append({'engine': engine, 'sheet': sheet,
+                            'seconds': seconds, 'same_as_pandas': same})
+    return pd.DataFrame(results)
+
+
+def df_equal(df, expected):
+    """
+    True if the two frames hold the same values, dtypes and column names
+    """
+    try:
+        pd.testing.assert_frame_equal(df, expected)
+        return True
+    except AssertionError:
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='compare the xlsx reading engines on a workbook')
+    parser.add_argument('workbook', help='xlsx file, e.g. an AO or D1000 file')
+    parser.add_argument('--sheet', action='append', default=None,
+                        help='sheet to parse (default: every sheet)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs per engine, the best one is reported')
+    parser.add_argument('--header', type=int, default=None,
+                        help='header row as in pd.read_excel; AO sheets are '
+                        'read without one, D1000 sheets with header 0')
+    args = parser.parse_args()
+
+    results = benchmark(args.workbook, args.sheet, args.repeat, args.header)
+    totals = results.groupby('engine', sort=False)['seconds'].sum()
+    print(results.to_string(index=False))
+    print("\nTotal seconds per engine:")
+    print(totals.to_string())
@@ -0,0 +1,158 @@
+"""
+# coding: utf-8
+
+# # Shared, pooled connections to the PGE_SIP database
+#
+# get_engine() returns one SQLAlchemy engine per database for the whole
+# process, so every sheet, upload and query reuses the connections in its
+# pool instead of setting up a new connection each time.
+#
+# The database is, in order of preference:
+#     - the URL given to get_engine() or configure()
+#     - the "url" in a JSON config file given to get_engine() or
+#       configure(), or named by the PGE_SIP_DB_CONFIG environment variable
+#     - the PGE_SIP_DB_URL environment variable
+#     - DEFAULT_URL, the PGE_SIP DSN with Windows authentication
+#
+# Any other keys in the config file are passed on to
+# sqlalchemy.create_engine, e.g. {"url": "...", "pool_size": 10, "echo": true}.
+# Pointing the URL at a local database, e.g. sqlite:///pge_sip_test.db, runs
+# the loaders against it instead of the server.
+"""
+
+###############################################################################
+# Load libraries and modules #
+###############################################################################
+import json
+import os
+import threading
+import sqlalchemy
+
+
+###############################################################################
+# Functions #
+###############################################################################
+
+# PGE_SIP must be set up as an ODBC Data Source (DSN) within Windows' ODBC
+# Data Source Administrator, pointing at server SFSVMSQL3, database PGE_SIP
+DEFAULT_URL = 'mssql+pyodbc://PGE_SIP'
+
+# Environment variables naming the database when no URL or config is given
+URL_VARIABLE = 'PGE_SIP_DB_URL'
+CONFIG_VARIABLE = 'PGE_SIP_DB_CONFIG'
+
+# Pool settings unless the config file sets them. Connections are checked
+# before use, so ones dropped by the server, e.g. overnight, are replaced
+POOL_OPTIONS = {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600,
+                'pool_pre_ping': True}
+
+# URL and config file used when get_engine() is called without them
+SETTINGS = {'url': None, 'config_file': None}
+
+# Engines created so far, by URL and options
+ENGINES = {}
+
+# Key in ENGINES for each combination of arguments and environment variables
+# get_engine() has been called with, so the config file is only read once
+RESOLVED = {}
+
+# Held while an engine is created, since sheets are uploaded from several
+# threads at once
+ENGINE_LOCK = threading.Lock()
+
+
+def configure(url=None, config_file=None):
+    """
+    Sets the database get_engine() uses when called without arguments
+    """
+    RESOLVED.clear()
+    SETTINGS['url'] = url
+    SETTINGS['config_file'] = config_file
+
+
+def read_settings(url=None, config_file=None):
+    """
+    Database URL and create_engine options, see the top of this file
+    """
+    config_file = config_file or os.environ.get(CONFIG_VARIABLE)
+    options = {}
+    if config_file:
+        with open(config_file) as f:
+            options = json.load(f)
+        url = url or options.pop('url', None)
+        options.pop('url', None)
+
+    url = url or os.environ.get(URL_VARIABLE) or DEFAULT_URL
+    return url, options
+
+
+def get_engine(url=None, config_file=None):
+    """
+    The process-wide pooled engine for the database, created on first use.
+    The settings are read once per combination of arguments, configure()
+    and environment variables
+    """
+    request = (url or SETTINGS['url'], config_file or SETTINGS['config_file'],
+               os.environ.get(URL_VARIABLE), os.environ.get(CONFIG_VARIABLE))
+    key = RESOLVED.get(request)
+    if key is not None and key in ENGINES:
+        return ENGINES[key]
+
+    with ENGINE_LOCK:
+        key = RESOLVED.get(request)
+        if key is None:
+            url, options = read_settings(*request[:2])
+            key = (url, json.dumps(options, sort_keys=True))
+        if key not in ENGINES:
+            url, options = key[0], json.loads(key[1])
+            # SQLite pools differ by version and file type, so its defaults
+            # are kept apart from the connection check
+            if sqlalchemy.engine.make_url(url).get_backend_name() == 'sqlite':
+                options = dict({'pool_pre_ping': True}, **options)
+            else:
+                options = dict(POOL_OPTIONS, **options)
+            ENGINES[key] = sqlalchemy.create_engine(url, **options)
+        RESOLVED[request] = key
+        return ENGINES[key]
+
+
+# SQLSTATEs of failures worth retrying: lost or refused connections,
+# timeouts, deadlocks and serialization failures
+TRANSIENT_STATES = ('08001', '08S01', '08S02', 'HYT00', 'HYT01', '40001',
+                    '40P01')
+
+# Messages of such failures from drivers that report no SQLSTATE, e.g.
+# sqlite3. Matched regardless of case
+TRANSIENT_MESSAGES = ('database is locked', 'database table is locked',
+                      'server closed the connection', 'connection reset',
+                      'connection timed out', 'communication link failure')
+
+
+def is_transient(error):
+    """
+    True if error is a database failure that may pass when retried. Other
+    errors, such as a missing table or bad SQL, fail the same way again
+    """
+    if isinstance(error, (sqlalchemy.exc.TimeoutError,
+                          sqlalchemy.exc.DisconnectionError)):
+        return True
+    if isinstance(error, sqlalchemy.exc.DBAPIError):
+        if error.connection_invalidated:
+            return True
+        if getattr(error.orig, 'pgcode', None) in TRANSIENT_STATES:
+            return True
+        message = str(error.orig)
+        return any(state in message for state in TRANSIENT_STATES) \
+            or any(text in message.lower() for text in TRANSIENT_MESSAGES)
+    return False
+
+
+def dispose_engines():
+    """
+    Closes the pooled connections of every engine created so far
+    """
+    with ENGINE_LOCK:
+        for engine in ENGINES.values():
+            engine.dispose()
+        ENGINES.clear()
+        RESOLVED.clear()
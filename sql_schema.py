@@ -0,0 +1,321 @@
+"""
+# coding: utf-8
+
+# # Compact SQL column types for the cleaned AO and D1000 sheets
+#
+# Left to itself, df.to_sql stores every text column as NVARCHAR(max) and
+# every number as FLOAT, and dates that come out of Excel as text stay text.
+# typed_frame() instead picks a compact type for each column of a cleaned
+# sheet:
+#
+#     - whole numbers: INTEGER or BIGINT
+#     - numbers with up to MAX_SCALE decimals: DECIMAL(precision, scale)
+#     - other numbers: FLOAT
+#     - dates: DATE, or DATETIME when any value has a time
+#     - text: VARCHAR(n), or NVARCHAR(n) with non-ASCII characters, where n
+#       is rounded up to a power of two but at most MAX_LENGTH of the type.
+#       Longer text is TEXT
+#     - columns without any value, e.g. a month left blank: FLOAT, kept as
+#       'null' so that the first file with values picks the type
+#
+# The types of each sheet are kept in a JSON file in a types folder, so every
+# load of that sheet uses the same table layout. A later file only ever
+# widens them, e.g. when a description grows longer than its VARCHAR, and a
+# blank column leaves them as they are. The files may be edited by hand to
+# fix a type.
+"""
+
+###############################################################################
+# Load libraries and modules #
+###############################################################################
+import datetime
+import json
+import os
+import re
+import pandas as pd
+import numpy as np
+import sqlalchemy
+from sqlalchemy.dialects import mssql
+
+
+###############################################################################
+# Functions #
+###############################################################################
+
+# Text columns holding dates, and their format
+DATE_COLUMNS = {'sourcefile_date': '%m%d%Y'}
+
+# Most decimals a DECIMAL column gets, and spare integer digits so that
+# larger amounts in later files still fit
+MAX_SCALE = 6
+SPARE_DIGITS = 4
+
+# Shortest VARCHAR, and the longest of each type before falling back to TEXT
+# (SQL Server's limits)
+MIN_LENGTH = 16
+MAX_LENGTH = {'varchar': 8000, 'nvarchar': 4000}
+
+# Type families, from narrowest to widest. A column whose types differ
+# between files gets the wider one
+NUMBER_TYPES = ['integer', 'bigint', 'decimal', 'float']
+DATE_TYPES = ['date', 'datetime']
+TEXT_TYPES = ['varchar', 'nvarchar', 'text']
+
+# Digits of the integer types, for widening them to DECIMAL
+INTEGER_DIGITS = {'integer': 10, 'bigint': 19}
+
+# Type of a column without any value, which any other type replaces
+NULL_SPEC = {'type': 'null'}
+
+
+def text_length(length, kind='varchar'):
+    """
+    Length of a VARCHAR or NVARCHAR (kind) for text of up to length
+    characters, or None if it is too long for one
+    """
+    if length > MAX_LENGTH[kind]:
+        return None
+    rounded = max(MIN_LENGTH, 2 ** int(np.ceil(np.log2(max(length, 1)))))
+    return min(rounded, MAX_LENGTH[kind])
+
+
+def text_spec(values):
+    """
+    Type of a column of strings
+    """
+    kind = 'varchar' if all(value.isascii() for value in values) \
+        else 'nvarchar'
+    length = text_length(max((len(value) for value in values), default=0),
+                         kind)
+    if length is None:
+        return {'type': 'text'}
+    return {'type': kind, 'length': length}
+
+
+def number_spec(values):
+    """
+    Type of a column of finite floats
+    """
+    if len(values) == 0:
+        return {'type': 'float'}
+    biggest = np.abs(values).max()
+    for scale in range(MAX_SCALE + 1):
+        if np.allclose(np.round(values, scale), values, rtol=1e-12, atol=0):
+            break
+    else:
+        return {'type': 'float'}
+
+    if scale == 0 and biggest < 2**63:
+        return {'type': 'integer' if biggest < 2**31 else 'bigint'}
+    digits = len(str(int(biggest))) + SPARE_DIGITS
+    if digits + scale > 38:
+        return {'type': 'float'}
+    return {'type': 'decimal', 'precision': digits + scale, 'scale': scale}
+
+
+def date_spec(values):
+    """
+    Type of a column of timestamps
+    """
+    if (values == values.dt.normalize()).all():
+        return {'type': 'date'}
+    return {'type': 'datetime'}
+
+
+def infer_spec(col):
+    """
+    Compact type of a column of a cleaned sheet, as a dictionary such as
+    {'type': 'varchar', 'length': 32}
+    """
+    if col.name in DATE_COLUMNS:
+        return {'type': 'date'}
+    if col.isna().all():
+        return dict(NULL_SPEC)
+    if pd.api.types.is_bool_dtype(col):
+        return {'type': 'boolean'}
+    if pd.api.types.is_integer_dtype(col):
+        return number_spec(col.to_numpy(dtype=float))
+    if pd.api.types.is_float_dtype(col):
+        values = col.to_numpy()
+        values = values[np.isfinite(values)]
+        return number_spec(values)
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return date_spec(col.dropna())
+
+    values = col.dropna()
+    if len(values) and all(isinstance(value, (datetime.date, pd.Timestamp))
+                           for value in values):
+        return date_spec(pd.to_datetime(values))
+    # Mixed columns are stored as text
+    return text_spec([str(value) for value in values])
+
+
+def merge_spec(old, new):
+    """
+    Type wide enough for the values of both types. A column without values
+    (NULL_SPEC) takes the other type
+    """
+    if old == new or new == NULL_SPEC:
+        return old
+    if old == NULL_SPEC:
+        return new
+    for family in (NUMBER_TYPES, DATE_TYPES, TEXT_TYPES):
+        if old['type'] in family and new['type'] in family:
+            break
+    else:
+        # e.g. numbers in one file and text in another
+        return {'type': 'text'}
+
+    wider = max(old, new, key=lambda spec: family.index(spec['type']))
+    spec = dict(wider)
+    if spec['type'] in ('varchar', 'nvarchar'):
+        spec['length'] = text_length(
+            max(old.get('length', 0), new.get('length', 0)), spec['type'])
+        if spec['length'] is None:
+            return {'type': 'text'}
+    elif spec['type'] == 'decimal':
+        scale = max(old.get('scale', 0), new.get('scale', 0))
+        digits = max(
+            INTEGER_DIGITS.get(each['type'],
+                               each.get('precision', 0) - each.get('scale', 0))
+            for each in (old, new))
+        if digits + scale > 38:
+            return {'type': 'float'}
+        spec = {'type': 'decimal', 'precision': digits + scale,
+                'scale': scale}
+    return spec
+
+
+def sql_type(spec):
+    """
+    SQLAlchemy type for a type dictionary
+    """
+    kind = spec['type']
+    if kind == 'integer':
+        return sqlalchemy.Integer()
+    if kind == 'bigint':
+        return sqlalchemy.BigInteger()
+    if kind == 'decimal':
+        return sqlalchemy.Numeric(spec['precision'], spec['scale'])
+    if kind in ('float', 'null'):
+        return sqlalchemy.Float(precision=53)
+    if kind == 'boolean':
+        return sqlalchemy.Boolean()
+    if kind == 'date':
+        return sqlalchemy.Date()
+    if kind == 'datetime':
+        return sqlalchemy.DateTime()
+    if kind == 'varchar':
+        return sqlalchemy.String(spec['length'])
+    if kind == 'nvarchar':
+        return sqlalchemy.Unicode(spec['length'])
+    # NTEXT, SQL Server's own UnicodeText, is deprecated
+    return sqlalchemy.UnicodeText().with_variant(mssql.NVARCHAR(), 'mssql')
+
+
+def column_spec(kind):
+    """
+    Type dictionary of a SQLAlchemy type, e.g. of a column read back from
+    the database, or None for types not made by sql_type
+    """
+    # The type behind a with_variant type
+    kind = getattr(kind, 'impl', kind)
+    if isinstance(kind, sqlalchemy.Boolean):
+        return {'type': 'boolean'}
+    if isinstance(kind, sqlalchemy.Float):
+        return {'type': 'float'}
+    if isinstance(kind, sqlalchemy.Numeric):
+        if kind.precision is None:
+            return {'type': 'float'}
+        return {'type': 'decimal', 'precision': kind.precision,
+                'scale': kind.scale or 0}
+    if isinstance(kind, sqlalchemy.BigInteger):
+        return {'type': 'bigint'}
+    if isinstance(kind, sqlalchemy.Integer):
+        return {'type': 'integer'}
+    if isinstance(kind, sqlalchemy.DateTime):
+        return {'type': 'datetime'}
+    if isinstance(kind, sqlalchemy.Date):
+        return {'type': 'date'}
+    if isinstance(kind, sqlalchemy.String):
+        # Text, and VARCHAR(max) or NVARCHAR(max) on SQL Server
+        if isinstance(kind, sqlalchemy.Text) or kind.length is None:
+            return {'type': 'text'}
+        if isinstance(kind, sqlalchemy.Unicode) or \
+                isinstance(kind, sqlalchemy.NCHAR):
+            return {'type': 'nvarchar', 'length': kind.length}
+        return {'type': 'varchar', 'length': kind.length}
+    return None
+
+
+def types_file(types_dir, key):
+    """
+    File holding the column types of a sheet, e.g. key 'AO_Sheet 1'
+    """
+    return os.path.join(types_dir, re.sub(r'[^\w.-]', '_', key) + '.json')
+
+
+def read_types(file):
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_types(file, types):
+    os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+    tmp = '{0}.{1}.tmp'.format(file, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(types, f, indent=2)
+    os.replace(tmp, file)
+
+
+def sheet_types(df, key, types_dir):
+    """
+    Column types for a cleaned sheet: those kept for the sheet in types_dir,
+    widened where df needs it, with types inferred for new columns. The
+    kept types are updated when they change
+    """
+    file = types_file(types_dir, key)
+    kept = read_types(file)
+
+    types = dict(kept)
+    for name, col in df.items():
+        spec = infer_spec(col)
+        types[str(name)] = merge_spec(kept[str(name)], spec) \
+            if str(name) in kept else spec
+
+    if types != kept:
+        write_types(file, types)
+    return {name: types[str(name)] for name in df.columns}
+
+
+def apply_types(df, types):
+    """
+    Converts the values of date columns to dates, parsing the text ones in
+    DATE_COLUMNS, so that they are stored as dates rather than text
+    """
+    df = df.copy()
+    for name, spec in types.items():
+        if spec['type'] not in DATE_TYPES:
+            continue
+        values = pd.to_datetime(df[name], format=DATE_COLUMNS.get(name))
+        if spec['type'] == 'date':
+            # Plain dates, which every driver binds as DATE
+            df[name] = pd.Series([None if pd.isnull(value) else value.date()
+                                  for value in values], index=df.index,
+                                 dtype=object)
+        else:
+            df[name] = values
+    return df
+
+
+def typed_frame(df, key, types_dir):
+    """
+    The cleaned sheet df ready for upload, and the dtype argument of
+    df.to_sql/upload_frame giving every column its kept type
+    """
+    types = sheet_types(df, key, types_dir)
+    return apply_types(df, types), {name: sql_type(spec)
+                                    for name, spec in types.items()}
@@ -0,0 +1,572 @@
+"""
+# coding: utf-8
+
+# # Bulk uploads of dataframes to the SQL database
+#
+# df.to_sql sends one INSERT round trip per row through pyodbc, which is why
+# uploading a D1000 file or the AO sheets takes 200 - 400 seconds.
+# upload_frame() lets pandas create the table as df.to_sql does and inserts
+# the rows with one of these strategies:
+#
+#     - 'executemany': one parameterised INSERT for a whole batch of rows. On
+#       pyodbc, fast_executemany is switched on so that the batch is sent to
+#       SQL Server as a single array of parameters
+#     - 'values': multi-row INSERT ... VALUES (...), (...) statements, as
+#       large as the database's limits on parameters and rows allow
+#     - 'copy': the rows are staged as a CSV file and bulk loaded, with COPY
+#       on PostgreSQL and BULK INSERT on SQL Server. BULK INSERT reads the
+#       file on the server, so stage_dir must be a folder the server can read
+#       under the same path, e.g. a network share
+#
+# Without a strategy, the one in DIALECT_STRATEGIES for the connection's
+# database is used. The connection may be a SQLAlchemy engine or connection,
+# or a sqlite3 connection for trying uploads against a local file.
+#
+# append_master() adds the rows of one source file to a master table that
+# collects every file, replacing earlier rows for the same file date so that
+# a load can safely be re-run.
+#
+# Running this file times the strategies against a local SQLite database:
+#     python sql_upload.py df_DB1000_01312020.csv --batch-size 5000
+"""
+
+###############################################################################
+# Load libraries and modules #
+###############################################################################
+import argparse
+import datetime
+import io
+import os
+import sqlite3
+import tempfile
+import time
+from functools import partial
+import pandas as pd
+import numpy as np
+
+
+###############################################################################
+# Functions #
+###############################################################################
+
+# Strategy used for each database when none is named
+DIALECT_STRATEGIES = {
+    'mssql': 'executemany',
+    'postgresql': 'copy',
+    'sqlite': 'executemany',
+    'mysql': 'values',
+}
+DEFAULT_STRATEGY = 'values'
+
+# Most parameters a statement may hold, and most rows in one VALUES list
+PARAMETER_LIMITS = {'mssql': 2100, 'sqlite': 999, 'postgresql': 32767,
+                    'mysql': 65535}
+ROW_LIMITS = {'mssql': 1000}
+
+# Rows sent per batch when no batch_size is given. The copy strategy stages
+# all rows in one file by default
+BATCH_SIZE = 10000
+
+# Database of a DBAPI connection, by the module it comes from
+DBAPI_DIALECTS = {'sqlite3': 'sqlite', 'pyodbc': 'mssql',
+                  'psycopg2': 'postgresql'}
+
+
+def dialect_name(con):
+    """
+    Name of the database behind a SQLAlchemy engine or connection, or behind
+    a DBAPI connection or cursor
+    """
+    dialect = getattr(con, 'dialect', None)
+    if dialect is not None:
+        return dialect.name
+    module = type(con).__module__.split('.')[0]
+    return DBAPI_DIALECTS.get(module, module)
+
+
+def dbapi_cursor(conn):
+    """
+    DBAPI cursor for the connection pandas passes to an insert method: a
+    SQLAlchemy connection, or already a cursor for sqlite3 connections
+    """
+    if hasattr(conn, 'executemany'):
+        return conn
+    return conn.connection.cursor()
+
+
+def quote_name(conn, name):
+    if hasattr(conn, 'dialect'):
+        return conn.dialect.identifier_preparer.quote(name)
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def insert_statement(pd_table, conn, keys, rows):
+    """
+    INSERT statement for the pandas table with a VALUES list of rows rows
+    """
+    table = quote_name(conn, pd_table.name)
+    if pd_table.schema:
+        table = quote_name(conn, pd_table.schema) + '.' + table
+    columns = ', '.join(quote_name(conn, key) for key in keys)
+
+    paramstyle = getattr(getattr(conn, 'dialect', None), 'paramstyle', 'qmark')
+    marker = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}[paramstyle]
+    row = '(' + ', '.join([marker] * len(keys)) + ')'
+    return 'INSERT INTO {0} ({1}) VALUES {2}'.format(
+        table, columns, ', '.join([row] * rows))
+
+
+def insert_executemany(pd_table, conn, keys, data_iter):
+    """
+    Inserts a batch of rows with one executemany call
+    """
+    rows = list(data_iter)
+    cursor = dbapi_cursor(conn)
+    try:
+        if hasattr(cursor, 'fast_executemany'):
+            cursor.fast_executemany = True
+        cursor.executemany(insert_statement(pd_table, conn, keys, 1), rows)
+    finally:
+        if cursor is not conn:
+            cursor.close()
+    return len(rows)
+
+
+def values_rows(dialect, columns):
+    """
+    Most rows one multi-row VALUES statement may hold
+    """
+    rows = max(1, PARAMETER_LIMITS.get(dialect, 999) // max(columns, 1))
+    return min(rows, ROW_LIMITS.get(dialect, rows))
+
+
+def insert_values(pd_table, conn, keys, data_iter):
+    """
+    Inserts a batch of rows as multi-row VALUES statements
+    """
+    rows = list(data_iter)
+    per_statement = values_rows(dialect_name(conn), len(keys))
+    statement = insert_statement(pd_table, conn, keys, per_statement)
+
+    cursor = dbapi_cursor(conn)
+    try:
+        for start in range(0, len(rows), per_statement):
+            chunk = rows[start:start + per_statement]
+            if len(chunk) < per_statement:
+                statement = insert_statement(pd_table, conn, keys, len(chunk))
+            cursor.execute(statement, [value for row in chunk for value in row])
+    finally:
+        if cursor is not conn:
+            cursor.close()
+    return len(rows)
+
+
+def stage_field(value):
+    """
+    Value as a field of a staged CSV file. None is an empty field, which COPY
+    and BULK INSERT load as NULL, while text is always quoted so that an
+    empty string stays one
+    """
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, (bool, np.bool_)):
+        return str(int(value))
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+    return str(value)
+
+
+def write_stage(f, rows):
+    for row in rows:
+        f.write(','.join([stage_field(value) for value in row]) + '\n')
+
+
+def insert_copy(pd_table, conn, keys, data_iter, stage_dir=None):
+    """
+    Stages a batch of rows as CSV and bulk loads it
+    """
+    rows = list(data_iter)
+    dialect = dialect_name(conn)
+    table = quote_name(conn, pd_table.name)
+    if pd_table.schema:
+        table = quote_name(conn, pd_table.schema) + '.' + table
+
+    cursor = dbapi_cursor(conn)
+    try:
+        if dialect == 'postgresql':
+            stage = io.StringIO()
+            write_stage(stage, rows)
+            stage.seek(0)
+            columns = ', '.join(quote_name(conn, key) for key in keys)
+            cursor.copy_expert('COPY {0} ({1}) FROM STDIN WITH CSV'.format(
+                table, columns), stage)
+        elif dialect == 'mssql':
+            # BULK INSERT has no column list, so the staged columns must be
+            # in the table's order, as they are in tables to_sql created
+            if stage_dir is None:
+                raise ValueError("The copy strategy on SQL Server needs a "
+                                 "stage_dir the server can read")
+            fd, path = tempfile.mkstemp(suffix='.csv', dir=stage_dir)
+            try:
+                with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+                    write_stage(f, rows)
+                cursor.execute(
+                    "BULK INSERT {0} FROM '{1}' WITH (FORMAT = 'CSV', "
+                    "ROWTERMINATOR = '0x0a', CODEPAGE = '65001', KEEPNULLS, "
+                    "TABLOCK)".format(
+                        table, path.replace("'", "''")))
+            finally:
+                os.remove(path)
+        else:
+            raise ValueError("The copy strategy is not available on "
+                             "{}".format(dialect))
+    finally:
+        if cursor is not conn:
+            cursor.close()
+    return len(rows)
+
+
+STRATEGIES = {
+    'executemany': insert_executemany,
+    'values': insert_values,
+    'copy': insert_copy,
+}
+
+
+def upload_frame(df, name, con, if_exists='fail', index=True, schema=None,
+                 dtype=None, strategy=None, batch_size=None, stage_dir=None):
+    """
+    Writes df to the table name like df.to_sql, inserting the rows with a
+    bulk strategy (see STRATEGIES). strategy=None picks the one for the
+    connection's database, batch_size is the number of rows per batch and
+    stage_dir is where the copy strategy stages its files.
+
+    Returns the strategy used
+    """
+    if strategy is None:
+        strategy = DIALECT_STRATEGIES.get(dialect_name(con), DEFAULT_STRATEGY)
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown upload strategy '{}'. Choose from {}".format(
+            strategy, list(STRATEGIES)))
+
+    method = STRATEGIES[strategy]
+    if strategy == 'copy':
+        method = partial(insert_copy, stage_dir=stage_dir)
+    else:
+        batch_size = batch_size or BATCH_SIZE
+
+    df.to_sql(name, con, schema=schema, if_exists=if_exists, index=index,
+              chunksize=batch_size, dtype=dtype, method=method)
+    return strategy
+
+
+def sql_type(col):
+    """
+    SQLAlchemy type of a column added to an existing table
+    """
+    import sqlalchemy
+
+    if pd.api.types.is_bool_dtype(col):
+        return sqlalchemy.Boolean()
+    if pd.api.types.is_integer_dtype(col):
+        return sqlalchemy.BigInteger()
+    if pd.api.types.is_float_dtype(col):
+        return sqlalchemy.Float(precision=53)
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return sqlalchemy.DateTime()
+    return sqlalchemy.Text()
+
+
+# Statement widening a column's type, by database. SQLite does not check
+# column types, so its columns never need widening
+ALTER_COLUMN = {
+    'mssql': 'ALTER TABLE {0} ALTER COLUMN {1} {2}',
+    'postgresql': 'ALTER TABLE {0} ALTER COLUMN {1} TYPE {2}',
+    'mysql': 'ALTER TABLE {0} MODIFY {1} {2}',
+    'sqlite': None,
+}
+
+# Longest index key SQL Server allows, in bytes
+INDEX_KEY_BYTES = 900
+
+
+def alter_column(conn, table, name, kind):
+    """
+    Changes the type of column name of the table to kind, compiled for the
+    connection's database, with its ALTER_COLUMN statement. Returns False
+    on SQLite, whose column types never need changing
+    """
+    import sqlalchemy
+
+    alter = ALTER_COLUMN[conn.dialect.name]
+    if not alter:
+        return False
+    preparer = conn.dialect.identifier_preparer
+    conn.execute(sqlalchemy.text(alter.format(
+        preparer.format_table(table), preparer.quote(name), kind)))
+    return True
+
+
+def wider_type(old, new):
+    """
+    SQLAlchemy type a column of type old has to be widened to for values of
+    type new, as sql_schema.merge_spec widens kept types, e.g. VARCHAR(32)
+    to NVARCHAR(64) or INTEGER to DECIMAL(12,2). None if old holds them
+    already, such as NVARCHAR(max) for any text, or if either type is one
+    sql_schema does not make
+    """
+    import sql_schema
+
+    old_spec = sql_schema.column_spec(old)
+    new_spec = sql_schema.column_spec(new)
+    if old_spec is None or new_spec is None:
+        return None
+    spec = sql_schema.merge_spec(old_spec, new_spec)
+    if spec == old_spec:
+        return None
+    return sql_schema.sql_type(spec)
+
+
+def align_columns(df, conn, table, add_columns=True, dtype=None):
+    """
+    Puts the columns of df in the order of the existing table, so monthly
+    files whose columns moved still line up with it. Names are matched
+    regardless of case, table columns missing from df are filled with NULL,
+    and columns the table lacks are added to it with their type in dtype, or
+    raise a ValueError without add_columns. Table columns too narrow for
+    their type in dtype are widened (see wider_type), or raise a ValueError
+    on databases without an ALTER_COLUMN statement
+    """
+    import sqlalchemy
+
+    dtype = dtype or {}
+
+    columns = [col.name for col in table.columns]
+    lookup = {name.lower(): name for name in columns}
+    df = df.rename(columns=lambda name: lookup.get(str(name).lower(), name))
+
+    new = [name for name in df.columns if name not in columns]
+    if new and not add_columns:
+        raise ValueError("Columns {} are not in {}".format(new, table.name))
+    preparer = conn.dialect.identifier_preparer
+    wanted = {str(name).lower(): kind for name, kind in dtype.items()}
+    for col in table.columns:
+        if col.name not in df.columns or col.name.lower() not in wanted:
+            continue
+        wider = wider_type(col.type, wanted[col.name.lower()])
+        if wider is None:
+            continue
+        wider = wider.compile(dialect=conn.dialect)
+        if conn.dialect.name not in ALTER_COLUMN:
+            raise ValueError(
+                "Column {0} of {1} is {2} but needs {3}, which must be set "
+                "by hand on {4}".format(
+                    col.name, table.name,
+                    col.type.compile(dialect=conn.dialect), wider,
+                    conn.dialect.name))
+        if alter_column(conn, table, col.name, wider):
+            print("Widened column {} of {} to {}".format(
+                col.name, table.name, wider))
+
+    for name in new:
+        conn.execute(sqlalchemy.text('ALTER TABLE {0} ADD {1} {2}'.format(
+            preparer.format_table(table), preparer.quote(str(name)),
+            dtype.get(name, sql_type(df[name])).compile(
+                dialect=conn.dialect))))
+        print("Added column {} to {}".format(name, table.name))
+
+    return df.reindex(columns=columns + new)
+
+
+def index_date_column(conn, table, date_column):
+    """
+    Creates an index on the date column of the table unless one starts with
+    it already, so that looking up a file date does not scan the table.
+
+    Masters made before the date column was typed hold it as unbounded text,
+    VARCHAR(max) on SQL Server, which cannot be an index key. Such a column
+    is first narrowed to a VARCHAR as long as its longest value, or as a date
+    in its sql_schema.DATE_COLUMNS format, so it keeps the text form
+    master_dates binds. Where that is not possible, the index is left out and
+    the table scanned instead
+    """
+    import sqlalchemy
+    import sql_schema
+
+    for index in sqlalchemy.inspect(conn).get_indexes(table.name,
+                                                      schema=table.schema):
+        if index['column_names'][:1] == [date_column]:
+            return
+
+    col = table.c[date_column]
+    if isinstance(col.type, sqlalchemy.String) and col.type.length is None:
+        fmt = sql_schema.DATE_COLUMNS.get(date_column)
+        date = datetime.date(2000, 12, 31)
+        longest = conn.execute(sqlalchemy.select(sqlalchemy.func.max(
+            sqlalchemy.func.length(col)))).scalar()
+        length = max(longest or 0,
+                     len(date.strftime(fmt) if fmt else date.isoformat()))
+        if conn.dialect.name not in ALTER_COLUMN or length > INDEX_KEY_BYTES:
+            print("Not indexing column {0} of {1}: its type {2} cannot be "
+                  "indexed and must be narrowed by hand, e.g. to "
+                  "VARCHAR({3})".format(date_column, table.name,
+                                        col.type.compile(dialect=conn.dialect),
+                                        length))
+            return
+        kind = sqlalchemy.VARCHAR(length).compile(dialect=conn.dialect)
+        if alter_column(conn, table, date_column, kind):
+            print("Narrowed column {} of {} to {} to index it".format(
+                date_column, table.name, kind))
+
+    name = 'ix_{0}_{1}'.format(table.name, date_column)[:128]
+    sqlalchemy.Index(name, table.c[date_column]).create(conn)
+
+
+def master_dates(df, col):
+    """
+    df with the values of its date column, the master's column col, in the
+    form the master stores them. Masters made before the date column was
+    typed hold it as text such as '01312020', in the format of
+    sql_schema.DATE_COLUMNS, and keep it so
+    """
+    import sqlalchemy
+    import sql_schema
+
+    fmt = sql_schema.DATE_COLUMNS.get(col.name)
+    if isinstance(col.type, sqlalchemy.String):
+        values = df[col.name].map(
+            lambda value: value if not isinstance(value, datetime.date)
+            else value.strftime(fmt) if fmt else value.isoformat())
+    elif isinstance(col.type, (sqlalchemy.Date, sqlalchemy.DateTime)):
+        values = df[col.name].map(
+            lambda value: value if not isinstance(value, str)
+            else pd.to_datetime(value, format=fmt).date())
+    else:
+        return df
+    return df.assign(**{col.name: values})
+
+
+def append_master(df, master, con, date_column='sourcefile_date',
+                  replace=True, add_columns=True, schema=None, **upload):
+    """
+    Appends df, the rows of one source file, to the master table in a single
+    transaction. The table and an index on date_column are created on first
+    use.
+
+    df must hold a single date_column value. Rows the master already holds
+    for that date, e.g. from an earlier or interrupted load of the same
+    file, are replaced, or left alone without appending anything when
+    replace is False. Re-running a load therefore never duplicates it. The
+    date column keeps the type it has in the master (see master_dates). See
+    align_columns for add_columns; the other options, such as dtype, are
+    those of upload_frame.
+
+    Returns 'created', 'appended', 'replaced' or 'skipped'
+    """
+    import sqlalchemy
+
+    dates = df[date_column].dropna().unique()
+    if len(dates) != 1:
+        raise ValueError("{} must hold a single date, not {}".format(
+            date_column, list(dates)))
+
+    with con.begin() as conn:
+        if not conn.dialect.has_table(conn, master, schema=schema):
+            upload_frame(df, master, conn, if_exists='fail', index=False,
+                         schema=schema, **upload)
+            table = sqlalchemy.Table(master, sqlalchemy.MetaData(),
+                                     autoload_with=conn, schema=schema)
+            index_date_column(conn, table, date_column)
+            return 'created'
+
+        table = sqlalchemy.Table(master, sqlalchemy.MetaData(),
+                                 autoload_with=conn, schema=schema)
+        index_date_column(conn, table, date_column)
+        dtype = {name: kind
+                 for name, kind in (upload.get('dtype') or {}).items()
+                 if str(name).lower() != date_column.lower()}
+        df = align_columns(df, conn, table, add_columns, dtype)
+
+        # Indexed lookup of a single row rather than reading every date, with
+        # the date bound as the master's column type
+        date_col = table.c[date_column]
+        df = master_dates(df, date_col)
+        date = df[date_column].dropna().iloc[0]
+        date = date.item() if hasattr(date, 'item') else date
+        found = conn.execute(sqlalchemy.select(date_col).where(
+            date_col == date).limit(1)).first()
+        status = 'appended'
+        if found is not None:
+            if not replace:
+                return 'skipped'
+            conn.execute(table.delete().where(date_col == date))
+            status = 'replaced'
+
+        upload_frame(df, master, conn, if_exists='append', index=False,
+                     schema=schema, **upload)
+    return status
+
+
+def benchmark(df, connect, strategies=None, batch_size=None, repeat=3):
+    """
+    Times uploading df with pandas' own to_sql and with each strategy, on a
+    fresh connection from connect() each time. Returns a dataframe with the
+    best time and the speedup over to_sql per strategy
+    """
+    strategies = strategies or ['to_sql'] + list(STRATEGIES)
+    results = []
+    for strategy in strategies:
+        best = np.inf
+        for _ in range(repeat):
+            con = connect()
+            start = time.perf_counter()
+            try:
+                if strategy == 'to_sql':
+                    df.to_sql('upload_benchmark', con, if_exists='replace')
+                else:
+                    upload_frame(df, 'upload_benchmark', con,
+                                 if_exists='replace', strategy=strategy,
+                                 batch_size=batch_size)
+            except ValueError as e:
+                print("Skipping {}: {}".format(strategy, e))
+                break
+            finally:
+                con.close()
+            best = min(best, time.perf_counter() - start)
+        else:
+            results.append({'strategy': strategy, 'seconds': best})
+
+    results = pd.DataFrame(results)
+    baseline = results.loc[results['strategy'] == 'to_sql', 'seconds']
+    if len(baseline):
+        results['speedup'] = baseline.iloc[0] / results['seconds']
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='compare the upload strategies on a local SQLite database')
+    parser.add_argument('csv', help='csv file to upload, e.g. one written by '
+                        'save_db')
+    parser.add_argument('--database', default=None,
+                        help='SQLite file to upload into (default: a '
+                        'temporary file)')
+    parser.add_argument('--strategy', action='append', default=None,
+                        choices=['to_sql'] + list(STRATEGIES),
+                        help='strategy to time (default: all of them)')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='rows per batch (default: {})'.format(BATCH_SIZE))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs per strategy, the best one is '
+                        'reported')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv)
+    with tempfile.TemporaryDirectory() as tmp:
+        database = args.database or os.path.join(tmp, 'upload_benchmark.db')
+        results = benchmark(df, lambda: sqlite3.connect(database),
+                            args.strategy, args.batch_size, args.repeat)
+    print("{} rows, {} columns".format(*df.shape))
+    print(results.to_string(index=False))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of CMIC_SL_comparison.py on synthetic jobs from CMIC_SL_benchmark.py
+"""
+
+import io
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import CMIC_SL_benchmark as benchmark
+import CMIC_SL_comparison as comparison
+
+
+# Phase numbers as they turn up in real reports, next to the generated ones
+ODD_PHASES = ['12345', '1234567.', 'A-100', '', ' 303000 ', '9.9']
+
+def sl_text(rows=500, seed=1):
+    # SL report as written to disk, with missing job and phase numbers and
+    # odd phase strings in the item descriptions
+    lines = benchmark.make_lines(123456, 0, rows, np.random.default_rng(seed))
+    lines = lines.astype({'job_no': object, 'phase_no': object})
+    lines.loc[lines.index[:20], 'job_no'] = np.nan
+    lines.loc[lines.index[20:40], 'phase_no'] = np.nan
+    lines.loc[lines.index[40:40+len(ODD_PHASES)], 'phase_no'] = ODD_PHASES
+
+    f = io.StringIO()
+    benchmark.sl_block(lines).to_csv(f, index=False, header=False)
+    return f.getvalue()
+
+def test_clean_sl_vectorized_matches_rowwise():
+    text = sl_text()
+    with warnings.catch_warnings():
+        # clean_sl_rowwise uses the deprecated DataFrame.append
+        warnings.simplefilter('ignore', FutureWarning)
+        rowwise = comparison.clean_sl_rowwise(pd.read_csv(io.StringIO(text),
+                                                          header=None))
+    vectorized = comparison.clean_sl_vectorized(
+        comparison.read_sl(io.StringIO(text)))
+
+    # The row-wise version keeps every report column, as read
+    derived = [col for col in vectorized.columns if isinstance(col, str)]
+    pd.testing.assert_frame_equal(rowwise[derived], vectorized[derived])
+    assert vectorized['ID'].str.startswith('nan_').sum() == 20
+    assert vectorized['phase_no'].isin(['nan'] + ODD_PHASES).sum() > 20
+
+def test_streamed_job_matches_in_memory(tmp_path):
+    loc = str(tmp_path) + '/'
+    cmic_file, sl_file = benchmark.write_job(loc, 900001, 3000)
+    # Blank trailing lines of the vendor dump, which land in the last chunk
+    with open(cmic_file, 'a') as f:
+        f.write(('\t' * (len(comparison.CMIC_COLUMNS) + benchmark.N_EXTRA_CMIC - 1)
+                 + '\n') * 5)
+
+    def compare(out, **options):
+        out_file, _ = comparison.compare_job('900001', cmic_file, sl_file,
+                                             loc + out, **options)
+        df = pd.read_csv(out_file, dtype=str)
+        return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+    in_memory = compare('full_')
+    streamed = compare('streamed_', chunksize=1000, partitions=4)
+    pd.testing.assert_frame_equal(in_memory, streamed)
+    assert in_memory['phase_no_cmic'].dropna().str.len().eq(7).all()
+
+def test_cache_is_kept_per_reader_engine(tmp_path):
+    loc = str(tmp_path) + '/'
+    cmic_file, sl_file = benchmark.write_job(loc, 900002, 500)
+    cache_dir = loc + '.clean_cache'
+    for engine in ['c', 'pyarrow', 'c']:
+        comparison.load_pair(cmic_file, sl_file, engine=engine, cache_dir=cache_dir)
+
+    cached = sorted(name.split('_')[2] for name in os.listdir(cache_dir))
+    assert len(cached) == 4
+    assert [name.split('-')[0] for name in cached] == ['c', 'c', 'pyarrow', 'pyarrow']
+
+def test_stages_are_only_recorded_for_a_collector(tmp_path):
+    loc = str(tmp_path) + '/'
+    cmic_file, sl_file = benchmark.write_job(loc, 900003, 500)
+    cmic, sl = comparison.load_pair(cmic_file, sl_file)
+    comparison.compare_dfs(cmic, sl)
+    assert comparison.STAGE_COLLECTORS == []
+
+    job_no, out_file, counts, stages, error = comparison.run_job(
+        ('900003', cmic_file, sl_file), loc)
+    assert error is None
+    assert [record['stage'] for record in stages] == [
+        'read_cmic', 'clean_cmic', 'read_sl', 'clean_sl', 'merge',
+        'compare_cols', 'write', 'total']
+    assert {record['job_no'] for record in stages} == {'900003'}
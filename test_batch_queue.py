@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the unattended load queue in batch_queue.py
+"""
+
+import json
+
+import pytest
+
+import batch_queue
+
+
+DEFAULTS = {'sheet': 'Milestones', 'out_dir': '.', 'confirm': False}
+
+
+def test_queue_expands_patterns_and_layers_options(tmp_path):
+    for name in ['D1000_01312020.xlsx', 'D1000_02282020.xlsx']:
+        (tmp_path / name).touch()
+    config = tmp_path / 'queue.json'
+    config.write_text(json.dumps({
+        'out_dir': 'csv', 'confirm': True,
+        'files': [str(tmp_path / 'D1000_*.xlsx'),
+                  {'path': str(tmp_path / 'missing.xlsx'), 'sheet': 'Other'}]}))
+
+    queue = batch_queue.read_queue(DEFAULTS, str(config), ['extra.xlsx'],
+                                   out_dir=None, confirm=False)
+    assert [batch_queue.file_date(path) for path, _ in queue[:2]] == [
+        '01312020', '02282020']
+    # Patterns matching nothing are kept, options given override the config
+    assert [(path.split('/')[-1], options) for path, options in queue[2:]] == [
+        ('missing.xlsx', {'sheet': 'Other', 'out_dir': 'csv', 'confirm': False}),
+        ('extra.xlsx', {'sheet': 'Milestones', 'out_dir': 'csv',
+                        'confirm': False})]
+
+    with pytest.raises(ValueError, match='sheets'):
+        batch_queue.read_queue(DEFAULTS, paths=[{'path': 'a.xlsx',
+                                                 'sheets': ['A']}])
+
+
+def test_failed_loads_are_returned():
+    def load(path, fail):
+        if fail:
+            raise RuntimeError('upload failed')
+
+    queue = [('a.xlsx', {'fail': False}), ('b.xlsx', {'fail': True}),
+             ('c.xlsx', {'fail': False})]
+    assert batch_queue.run_queue(queue, load) == ['b.xlsx']
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of sql_connection.py against an in-memory SQLite database
+"""
+
+import sqlite3
+
+import sqlalchemy
+
+import sql_connection
+
+
+def error_of(engine, sql):
+    try:
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text(sql))
+    except sqlalchemy.exc.DBAPIError as e:
+        return e
+
+def test_only_passing_failures_are_transient():
+    engine = sqlalchemy.create_engine('sqlite://')
+    error_of(engine, 'create table t (a int)')
+    for sql in ['select * from missing', 'create table t (a int)', 'selec 1']:
+        error = error_of(engine, sql)
+        assert isinstance(error, sqlalchemy.exc.OperationalError)
+        assert not sql_connection.is_transient(error)
+
+    locked = sqlalchemy.exc.OperationalError(
+        'insert', {}, sqlite3.OperationalError('database is locked'))
+    dropped = sqlalchemy.exc.DBAPIError(
+        'insert', {}, Exception('08S01', '[08S01] Communication link failure'))
+    assert sql_connection.is_transient(locked)
+    assert sql_connection.is_transient(dropped)
+    assert sql_connection.is_transient(sqlalchemy.exc.TimeoutError())
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the column types sql_schema.py infers for cleaned sheets
+"""
+
+import numpy as np
+import pandas as pd
+
+import sql_schema
+import sql_upload
+
+
+def test_text_lengths_stay_within_the_type_limit():
+    spec = lambda text: sql_schema.infer_spec(pd.Series([text]))
+    assert spec('a' * 100) == {'type': 'varchar', 'length': 128}
+    assert spec('a' * 3000) == {'type': 'varchar', 'length': 4096}
+    assert spec('a' * 5000) == {'type': 'varchar', 'length': 8000}
+    assert spec('a' * 8001) == {'type': 'text'}
+    assert spec('é' * 3000) == {'type': 'nvarchar', 'length': 4000}
+    assert spec('é' * 4001) == {'type': 'text'}
+
+    # Widening ASCII text to NVARCHAR keeps it within the NVARCHAR limit
+    merged = sql_schema.merge_spec({'type': 'varchar', 'length': 8000},
+                                   {'type': 'nvarchar', 'length': 16})
+    assert merged == {'type': 'text'}
+
+
+def test_blank_columns_keep_the_kept_types(tmp_path):
+    month = pd.DataFrame({'Job': [1, 2], 'Amount': [1.5, 2.25],
+                          'Desc': ['abc', 'de'], 'Start': pd.to_datetime(
+                              ['2020-01-01', '2020-01-02'])})
+    _, first = sql_schema.typed_frame(month, 'AO_Sheet', str(tmp_path))
+    kept = sql_schema.read_types(sql_schema.types_file(str(tmp_path),
+                                                       'AO_Sheet'))
+
+    # A month with the amounts, descriptions and dates left blank, as read
+    # from Excel and after infer_objects
+    blank = month.assign(Amount=np.nan, Desc=None, Start=pd.NaT)
+    typed, second = sql_schema.typed_frame(blank, 'AO_Sheet', str(tmp_path))
+    assert sql_schema.read_types(sql_schema.types_file(
+        str(tmp_path), 'AO_Sheet')) == kept
+    assert typed['Amount'].isna().all() and typed['Start'].isna().all()
+    # so the master's columns are not widened either
+    for name in month.columns:
+        assert sql_upload.wider_type(first[name], second[name]) is None
+
+    # A column blank from the start takes the type of the first values
+    _, dtype = sql_schema.typed_frame(blank, 'AO_Other', str(tmp_path))
+    _, dtype = sql_schema.typed_frame(month, 'AO_Other', str(tmp_path))
+    assert [sql_schema.column_spec(dtype[name])['type']
+            for name in month.columns] == ['integer', 'decimal', 'varchar',
+                                           'date']
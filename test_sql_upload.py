@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the master table helpers in sql_upload.py
+"""
+
+import pandas as pd
+import sqlalchemy
+from sqlalchemy.dialects import mssql
+
+import sql_schema
+import sql_upload
+
+
+SHEET = pd.DataFrame({'Job': [1, 2, 3], 'Amount': [1.5, 2.25, 3.0]})
+
+
+def load(engine, types_dir, date='01312020'):
+    df, dtype = sql_schema.typed_frame(SHEET.assign(sourcefile_date=date),
+                                       'AO_Sheet', types_dir)
+    return sql_upload.append_master(df, 'master', engine, dtype=dtype)
+
+
+def master_dates(engine):
+    return pd.read_sql('select sourcefile_date, count(*) as n from master '
+                       'group by sourcefile_date order by 1', engine)
+
+
+def test_reloads_replace_rows_of_a_text_dated_master(tmp_path):
+    # A master as the loaders made it before sourcefile_date was typed
+    engine = sqlalchemy.create_engine('sqlite://')
+    SHEET.assign(sourcefile_date='01312020').to_sql('master', engine,
+                                                    index=False)
+
+    assert load(engine, str(tmp_path)) == 'replaced'
+    assert load(engine, str(tmp_path)) == 'replaced'
+    assert load(engine, str(tmp_path), '02282020') == 'appended'
+    assert master_dates(engine).values.tolist() == [['01312020', 3],
+                                                    ['02282020', 3]]
+
+
+def test_reloads_replace_rows_of_a_date_master(tmp_path):
+    engine = sqlalchemy.create_engine('sqlite://')
+    assert load(engine, str(tmp_path)) == 'created'
+    assert load(engine, str(tmp_path)) == 'replaced'
+    assert master_dates(engine).values.tolist() == [['2020-01-31', 3]]
+
+
+def test_unbounded_text_dates_are_narrowed_before_indexing(monkeypatch):
+    # VARCHAR(max) cannot be an index key on SQL Server. SQLite has no ALTER
+    # COLUMN, so the statements are recorded instead of run
+    altered = []
+    monkeypatch.setitem(sql_upload.ALTER_COLUMN, 'sqlite', 'ALTER COLUMN')
+    monkeypatch.setattr(sql_upload, 'alter_column',
+                        lambda conn, table, name, kind:
+                        altered.append((name, kind)) or True)
+    engine = sqlalchemy.create_engine('sqlite://')
+    SHEET.assign(sourcefile_date='01312020').to_sql('master', engine,
+                                                    index=False)
+    sql_upload.append_master(SHEET.assign(sourcefile_date='02282020'),
+                             'master', engine)
+    assert altered == [('sourcefile_date', 'VARCHAR(8)')]
+    assert sqlalchemy.inspect(engine).get_indexes('master')
+
+    # Without a way to narrow it the column is left unindexed
+    monkeypatch.delitem(sql_upload.ALTER_COLUMN, 'sqlite')
+    engine = sqlalchemy.create_engine('sqlite://')
+    SHEET.assign(sourcefile_date='01312020').to_sql('master', engine,
+                                                    index=False)
+    assert sql_upload.append_master(SHEET.assign(sourcefile_date='02282020'),
+                                    'master', engine) == 'appended'
+    assert not sqlalchemy.inspect(engine).get_indexes('master')
+
+
+def test_master_columns_widen_with_the_kept_types():
+    compiled = lambda old, new: sql_upload.wider_type(old, new).compile(
+        dialect=mssql.dialect())
+    assert compiled(sqlalchemy.String(32), sqlalchemy.UnicodeText()) \
+        == 'NVARCHAR(max)'
+    assert compiled(sqlalchemy.String(64), sqlalchemy.Unicode(64)) \
+        == 'NVARCHAR(64)'
+    assert compiled(sqlalchemy.Integer(), sqlalchemy.BigInteger()) == 'BIGINT'
+    assert compiled(sqlalchemy.Integer(), sqlalchemy.Numeric(12, 2)) \
+        == 'NUMERIC(12, 2)'
+    # DECIMAL(6,1) alone would not hold the integers already there
+    assert compiled(sqlalchemy.Integer(), sqlalchemy.Numeric(6, 1)) \
+        == 'NUMERIC(11, 1)'
+
+    # Columns wide enough already are left alone
+    assert sql_upload.wider_type(mssql.NVARCHAR(), sqlalchemy.String(16)) is None
+    assert sql_upload.wider_type(mssql.FLOAT(53), sqlalchemy.Numeric(8, 2)) is None
+    assert sql_upload.wider_type(mssql.DATETIME(), sqlalchemy.Date()) is None